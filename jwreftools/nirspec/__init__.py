@@ -9,3 +9,7 @@ from .ifu_slicer2asdf import *
 from .ote2asdf import *
 from .wave_range2asdf import *
 from .msa2asdf import *
+from .cache import *
+from .polynomial import *
+from .manifest import *
+from .writer import *
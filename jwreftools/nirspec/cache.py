@@ -0,0 +1,183 @@
+"""
+A persistent, content addressed cache of parsed NIRSPEC IDT files.
+
+Entries are keyed by a hash of the bytes of the input file and the
+converter version, so an edited file or a new version of the converters
+never returns a stale entry. Two kinds of entries are stored:
+
+- the parsed `~jwreftools.nirspec.utils.PcfDocument`, including the
+  coefficient blocks read from it,
+- optionally, the pickled models built from the document.
+
+The cache is bounded in size. When it grows beyond ``max_size`` the least
+recently used entries are removed.
+
+Examples
+--------
+>>> cache = ModelCache("/tmp/nirspec_cache")
+>>> generate(model_dir, cache=cache)
+
+"""
+import hashlib
+import os
+import pickle
+import threading
+import warnings
+
+from .utils import PcfDocument
+
+
+__all__ = ['ModelCache', 'file_hash']
+
+
+# Increase when the parsing or the models built from a file change.
+CACHE_VERSION = 4
+
+
+def converter_version():
+    """ Return the version string included in the cache keys."""
+    try:
+        from .. import __version__
+    except ImportError:
+        __version__ = ''
+    return "{0}:{1}".format(__version__, CACHE_VERSION)
+
+
+def file_hash(data):
+    """
+    Return a hash of the contents of a file and the converter version.
+
+    Parameters
+    ----------
+    data : str or bytes
+        File name or the contents of the file.
+    """
+    if not isinstance(data, bytes):
+        with open(data, 'rb') as f:
+            data = f.read()
+    digest = hashlib.sha256(converter_version().encode('ascii'))
+    digest.update(data)
+    return digest.hexdigest()
+
+
+class ModelCache(object):
+    """
+    On-disk cache of parsed IDT files and models built from them.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory with the cache. Defaults to ``$JWREFTOOLS_CACHE`` or
+        ``~/.jwreftools/cache``.
+    max_size : int
+        Maximum size of the cache in bytes.
+    store_models : bool
+        If True, pickle the models built from the parsed files too.
+    """
+    def __init__(self, cache_dir=None, max_size=512 * 2**20, store_models=True):
+        if cache_dir is None:
+            cache_dir = os.environ.get('JWREFTOOLS_CACHE',
+                                       os.path.join(os.path.expanduser('~'), '.jwreftools', 'cache'))
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.store_models = store_models
+
+    def _path(self, digest, kind):
+        return os.path.join(self.cache_dir, "{0}.{1}.pickle".format(digest, kind))
+
+    def load(self, digest, kind):
+        """ Return a cached object or None."""
+        path = self._path(digest, kind)
+        # The entry can be removed by `evict` in another thread or process
+        # at any time, which is a cache miss.
+        try:
+            with open(path, 'rb') as f:
+                obj = pickle.load(f)
+            # Mark the entry as recently used.
+            os.utime(path, None)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return obj
+
+    def save(self, digest, kind, obj):
+        """ Store an object in the cache."""
+        path = self._path(digest, kind)
+        tmp = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            os.remove(tmp)
+            warnings.warn("Object {0} could not be cached: {1}".format(kind, e))
+            return
+        os.rename(tmp, path)
+        self.evict()
+
+    def read(self, pcffile):
+        """
+        Return the parsed `PcfDocument` for a file.
+
+        The file is parsed only if its contents are not in the cache.
+        """
+        with open(pcffile, 'rb') as f:
+            data = f.read()
+        digest = file_hash(data)
+        pcf = self.load(digest, 'document')
+        if pcf is None:
+            pcf = PcfDocument.from_bytes(data, filename=pcffile)
+            pcf.digest = digest
+            self.save(digest, 'document', pcf)
+        pcf.filename = pcffile
+        return pcf
+
+    def model(self, pcf, kind, builder):
+        """
+        Return a model built from a parsed file.
+
+        Parameters
+        ----------
+        pcf : `PcfDocument`
+            A document returned by `ModelCache.read`.
+        kind : str
+            Identifies the model built from the document, e.g. "pcf2model-camera".
+        builder : callable
+            Called with no arguments to build the model if it's not cached.
+        """
+        if not self.store_models or pcf.digest is None:
+            return builder()
+        model = self.load(pcf.digest, kind)
+        if model is None:
+            model = builder()
+            self.save(pcf.digest, kind, model)
+            # Keep the coefficient blocks parsed by the builder.
+            self.save(pcf.digest, 'document', pcf)
+        return model
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in ``max_size``."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pickle'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        """ Remove all entries."""
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pickle'):
+                os.remove(os.path.join(self.cache_dir, name))
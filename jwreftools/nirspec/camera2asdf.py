@@ -1,13 +1,14 @@
 import datetime
-from .utils import pcf2model
+from .utils import pcf2model, PcfDocument
+from .writer import write_reference
 from jwst.datamodels import CameraModel
 from asdf.tags.core import Software, HistoryEntry
 
 __all__ = ["create_camera_reference", "camera2asdf"]
 
-def camera2asdf(camera_refname, author, description, useafter):
+def camera2asdf(camera_refname, author, description, useafter, cache=None):
     try:
-        model = pcf2model(camera_refname, name='camera')
+        model = pcf2model(camera_refname, name='camera', cache=cache)
     except:
         print("Camera file was not converted.")
         raise
@@ -25,20 +26,12 @@ def camera2asdf(camera_refname, author, description, useafter):
 
     return camera_model
 
-def create_camera_reference(camera_refname, out_name, author=None, description=None, useafter=None):
-    with open(camera_refname) as f:
-        lines = f.readlines()
-        lines = [l.strip() for l in lines]
-    for i, line in enumerate(lines):
-        if 'AUTHOR' in line:
-            auth = lines[i + 1]
-            continue
-        elif 'DESCRIPTION' in line:
-            descrip = lines[i + 1]
-            continue
-        elif 'DATE' in line:
-            date = lines[i + 1]
-            continue
+def create_camera_reference(camera_refname, out_name, author=None, description=None, useafter=None,
+                            cache=None, write_options=None):
+    pcf = PcfDocument.read(camera_refname, cache=cache)
+    auth = pcf.header['author']
+    descrip = pcf.header['description']
+    date = pcf.header['date']
 
     if author is None:
         author = auth
@@ -48,10 +41,10 @@ def create_camera_reference(camera_refname, out_name, author=None, description=N
         useafter = date
 
     try:
-        model = camera2asdf(camera_refname, author, description, useafter)
+        model = camera2asdf(pcf, author, description, useafter, cache=cache)
     except:
         raise
-    model.to_asdf(out_name)
+    write_reference(model, out_name, reftype='camera', **(write_options or {}))
     new_model = CameraModel(out_name)
     new_model.validate()
 
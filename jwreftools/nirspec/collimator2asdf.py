@@ -1,14 +1,15 @@
 import datetime
-from .utils import pcf2model#, common_reference_file_keywords)
+from .utils import pcf2model, PcfDocument
+from .writer import write_reference
 from jwst.datamodels import CollimatorModel
 from asdf.tags.core import Software, HistoryEntry
 
 __all__ = ["create_collimator_reference", "collimator2asdf"]
 
 
-def collimator2asdf(collimator_refname, author, description, useafter):
+def collimator2asdf(collimator_refname, author, description, useafter, cache=None):
     try:
-        model = pcf2model(collimator_refname, name="collimator")
+        model = pcf2model(collimator_refname, name="collimator", cache=cache)
     except:
         print("Collimator file was not converted.")
         raise
@@ -27,20 +28,12 @@ def collimator2asdf(collimator_refname, author, description, useafter):
     return collimator_model
 
 
-def create_collimator_reference(collimator_refname, out_name, author=None, description=None, useafter=None):
-    with open(collimator_refname) as f:
-        lines = f.readlines()
-        lines = [l.strip() for l in lines]
-    for i, line in enumerate(lines):
-        if 'AUTHOR' in line:
-            auth = lines[i + 1]
-            continue
-        elif 'DESCRIPTION' in line:
-            descrip = lines[i + 1]
-            continue
-        elif 'DATE' in line:
-            date = lines[i + 1]
-            continue
+def create_collimator_reference(collimator_refname, out_name, author=None, description=None, useafter=None,
+                                cache=None, write_options=None):
+    pcf = PcfDocument.read(collimator_refname, cache=cache)
+    auth = pcf.header['author']
+    descrip = pcf.header['description']
+    date = pcf.header['date']
 
     if author is None:
         author = auth
@@ -49,9 +42,9 @@ def create_collimator_reference(collimator_refname, out_name, author=None, descr
     if useafter is None:
         useafter = date
     try:
-        model = collimator2asdf(collimator_refname, author, description, useafter)
+        model = collimator2asdf(pcf, author, description, useafter, cache=cache)
     except:
         raise
-    model.to_asdf(out_name)
+    write_reference(model, out_name, reftype='collimator', **(write_options or {}))
     new_model = CollimatorModel(out_name)
     new_model.validate()
@@ -5,17 +5,518 @@ For each slit it writes the results as a cube with three planes
 (wavelength, ra, dec) in a separate fits extension.
 The file is saved with an suffix "world_coordinates".
 
+The output file is created with its final size before any transform is
+evaluated. Each slit is then evaluated in blocks of rows and the blocks are
+written to their place in the file, so the memory used does not depend on
+the number or the size of the slits. With ``workers`` > 1 the slits are
+evaluated in a pool of processes, each writing its slits to the file.
+
+Small MSA slitlets whose transforms differ only in the values of some
+parameters are evaluated together: their pixels are concatenated and the
+varying parameters are given one value per pixel, so the transform is
+called once for many slits. Only models evaluated point by point are
+batched; the result agrees with the evaluation of each slit to rounding.
+
+Pixels outside the bounding box of the WCS of a slit are not evaluated;
+they are NaN in the output, as they are in the output of gwcs. The WCS
+bounding box is used for every output frame, since the transforms
+between its frames don't carry it.
+
+The planes can be written as float32, in GZIP tile compressed extensions,
+or to an ASDF file with one block for each slit. Compressed files are
+converted from a temporary uncompressed file, one slit at a time. One slit
+of an ASDF file is read without reading the others, and memory mapped if
+the blocks are not compressed::
+
+    >>> with asdf.open('nrs1_msa.asdf') as af:
+    ...     lam, msa_x, msa_y = af.tree['slits'][10]['data']
+
 Requested by the NIRSPEC team.
 
 """
 from __future__ import absolute_import, division, unicode_literals, print_function
 
+import inspect
+import os
+import pickle
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import asdf
 from astropy.io import fits
+from astropy.modeling.core import Model, CompoundModel
+from astropy.modeling.models import (Shift, Scale, Multiply, Const1D, Const2D,
+                                     Polynomial1D, Polynomial2D)
 from jwst_lib import models
 
+from .writer import COMPRESSION
+
+
+__all__ = ['compute_world_coordinates', 'compute_msa_coordinates']
+
+
+# Maximum number of pixels evaluated at once.
+TILE_PIXELS = 2**16
+
+# Models evaluated point by point, which can be given one parameter value per point.
+ELEMENTWISE_MODELS = (Shift, Scale, Multiply, Const1D, Const2D, Polynomial1D, Polynomial2D)
+
+WORLD_PLANES = ['lambda, microns', 'ote_x, arcsec', 'ote_y, arcsec']
+
+MSA_PLANES = ['lambda, microns', 'msa_x, relative to center of slit (0, 0)',
+              'msa_y, relative to center of slit (0, 0)']
+
+FORMATS = ['fits', 'asdf']
+
+# Lossless tile compression of floating point FITS images.
+FITS_COMPRESSION = [None, 'GZIP_1', 'GZIP_2']
+
 
-def compute_world_coordinates(fname, output=None):
+def _output_name(model, output, suffix, ext='.fits'):
+    """ Return the name of the output file, ending with ``_<suffix><ext>``."""
+    if output is None:
+        root = model.meta.filename.split('_')
+        return "".join([root[0], '_', suffix, ext])
+    base = os.path.splitext(output)[0]
+    if not base.endswith(suffix):
+        base = "".join([base, '_', suffix])
+    return "".join([base, ext])
+
+
+def _slit_transform(slit, frame=None):
+    """
+    Return the transform from the detector to ``frame`` of a slit.
+
+    The transform returns (x, y, lam); ``frame=None`` is the world frame.
+    """
+    if frame is None:
+        return slit.meta.wcs
+    return slit.meta.wcs.get_transform('detector', frame)
+
+
+def _image_header(shape, dtype):
+    """ Return the header of an image extension for data of ``shape`` and ``dtype``."""
+    bitpix = {np.dtype(np.float64): -64, np.dtype(np.float32): -32}[np.dtype(dtype)]
+    cards = [('XTENSION', 'IMAGE', 'Image extension'),
+             ('BITPIX', bitpix, 'array data type'),
+             ('NAXIS', len(shape), 'number of array dimensions')]
+    for i, n in enumerate(shape[::-1]):
+        cards.append(('NAXIS{0}'.format(i + 1), n))
+    cards.extend([('PCOUNT', 0, 'number of parameters'), ('GCOUNT', 1, 'number of groups')])
+    return fits.Header(cards)
+
+
+def _create_file(output, primary_header, headers, shapes, dtype):
+    """
+    Create a FITS file with image extensions of the given shapes.
+
+    The headers are written and the file is extended to its final size;
+    the data are filled in later with `_write_rows`.
+
+    Returns
+    -------
+    offsets : list of int
+        Offset in bytes of the data of each extension.
+    """
+    if os.path.exists(output):
+        raise IOError("File {0} already exists.".format(output))
+    itemsize = np.dtype(dtype).itemsize
+    offsets = []
+    with open(output, 'wb') as f:
+        f.write(primary_header.tostring().encode('ascii'))
+        for header, shape in zip(headers, shapes):
+            f.write(header.tostring().encode('ascii'))
+            offsets.append(f.tell())
+            nbytes = int(np.prod(shape)) * itemsize
+            # Data are padded to a multiple of 2880 bytes.
+            f.seek(-(-nbytes // 2880) * 2880, os.SEEK_CUR)
+        f.truncate(f.tell())
+    return offsets
+
+
+def _write_rows(f, offset, shape, row, planes, dtype):
+    """
+    Write rows of the planes of an image extension.
+
+    Parameters
+    ----------
+    f : file
+        The output file, opened for writing.
+    offset : int
+        Offset of the data of the extension.
+    shape : tuple
+        (nplanes, ny, nx) shape of the data.
+    row : int
+        Index of the first row in ``planes``.
+    planes : list of ndarray
+        One (nrows, nx) array for each plane.
+    """
+    nplanes, ny, nx = shape
+    dtype = np.dtype(dtype).newbyteorder('>')
+    for i, plane in enumerate(planes):
+        f.seek(offset + (i * ny + row) * nx * dtype.itemsize)
+        f.write(np.ascontiguousarray(plane, dtype=dtype).tobytes())
+
+
+def _row_blocks(shape, tile_pixels=TILE_PIXELS):
+    """ Yield (start, stop) of the blocks of rows of an image of ``shape``."""
+    ysize, xsize = shape
+    nrows = max(1, tile_pixels // max(xsize, 1))
+    for start in range(0, ysize, nrows):
+        yield start, min(start + nrows, ysize)
+
+
+def _bounding_box(transform):
+    """
+    Return ((x0, x1), (y0, y1)), the bounding box of a transform, or None.
+    """
+    try:
+        bbox = transform.bounding_box
+    except NotImplementedError:
+        return None
+    if bbox is None:
+        return None
+    if hasattr(bbox, 'intervals'):
+        # astropy ModelBoundingBox, the intervals are indexed by input.
+        if 0 not in bbox.intervals or 1 not in bbox.intervals:
+            return None
+        return tuple(tuple(bbox.intervals[i]) for i in (0, 1))
+    if isinstance(transform, Model):
+        # Bounding box tuples of models are in reverse order of the inputs,
+        # those of a gwcs WCS in the order of the inputs.
+        bbox = bbox[::-1]
+    return tuple(tuple(interval) for interval in bbox)
+
+
+def _slit_bounding_box(slit):
+    """ Return the bounding box of the detector pixels of a slit, from its WCS, or None."""
+    return _bounding_box(slit.meta.wcs)
+
+
+def _valid_pixels(bbox, start, stop, xsize):
+    """ Return the mask of the pixels of rows ``start:stop`` inside a bounding box."""
+    (x0, x1), (y0, y1) = bbox
+    x = np.arange(xsize)
+    y = np.arange(start, stop)
+    return ((y >= y0) & (y <= y1))[:, np.newaxis] & ((x >= x0) & (x <= x1))
+
+
+def _evaluate(transform, x, y, valid=None):
+    """
+    Evaluate a transform at the ``valid`` pixels.
+
+    Returns
+    -------
+    planes : ndarray
+        (lam, x, y) planes, NaN at the other pixels.
+    """
+    if valid is None:
+        x, y, lam = transform(x, y)
+        return np.array([lam, x, y])
+    planes = np.empty((3,) + x.shape)
+    planes.fill(np.nan)
+    if valid.any():
+        x, y, lam = transform(x[valid], y[valid])
+        planes[:, valid] = [lam, x, y]
+    return planes
+
+
+def _write_slit(f, slit, offset, shape, frame, tile_pixels, dtype, with_bounding_box=True):
+    """ Evaluate the transform of a slit in blocks of rows and write them to ``f``."""
+    transform = _slit_transform(slit, frame)
+    bbox = _slit_bounding_box(slit) if with_bounding_box else None
+    for start, stop in _row_blocks(shape[1:], tile_pixels):
+        y, x = np.mgrid[start: stop, : shape[2]]
+        valid = None if bbox is None else _valid_pixels(bbox, start, stop, shape[2])
+        _write_rows(f, offset, shape, start, _evaluate(transform, x, y, valid), dtype)
+
+
+def _leaves(transform):
+    """ Return the models of a compound model, in the order of the expression."""
+    if not isinstance(transform, CompoundModel):
+        return [transform]
+    if transform.op == 'fix_inputs':
+        return _leaves(transform.left)
+    return _leaves(transform.left) + _leaves(transform.right)
+
+
+def _replace_leaves(transform, leaves):
+    """ Return ``transform`` with its models taken from the iterator ``leaves``."""
+    if not isinstance(transform, CompoundModel):
+        return next(leaves)
+    left = _replace_leaves(transform.left, leaves)
+    if transform.op == 'fix_inputs':
+        return CompoundModel(transform.op, left, transform.right)
+    return CompoundModel(transform.op, left, _replace_leaves(transform.right, leaves))
+
+
+# Constructor arguments of each model class, except the model set and name arguments.
+_init_arguments = {}
+
+
+def _leaf_config(leaf):
+    """ Return the arguments of a model's constructor which are not parameters."""
+    cls = type(leaf)
+    if cls not in _init_arguments:
+        _init_arguments[cls] = [
+            name for name, arg in inspect.signature(cls.__init__).parameters.items()
+            if name not in ('self', 'n_models', 'model_set_axis', 'name', 'meta') and
+            arg.kind not in (arg.VAR_POSITIONAL, arg.VAR_KEYWORD)]
+    return dict((name, getattr(leaf, name)) for name in _init_arguments[cls]
+                if name not in leaf.param_names and hasattr(leaf, name))
+
+
+def _structure(transform):
+    """ The expression, model classes and constructor arguments of a transform."""
+    if isinstance(transform, CompoundModel):
+        if transform.op == 'fix_inputs':
+            return ('fix_inputs', _structure(transform.left), sorted(transform.right.items()))
+        return (transform.op, _structure(transform.left), _structure(transform.right))
+    return (type(transform).__name__, transform.param_names,
+            [getattr(transform, name).shape for name in transform.param_names],
+            sorted(_leaf_config(transform).items()))
+
+
+def _transform_key(transform):
+    """
+    Return a key equal for transforms which differ only in parameter values,
+    or None if the transform can't be evaluated with other slits.
+    """
+    if not isinstance(transform, Model):
+        return None
+    try:
+        return pickle.dumps(_structure(transform), protocol=2)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+
+
+def _batched_transform(transforms, slit_ids):
+    """
+    Return a transform evaluating ``transforms[slit_ids[i]]`` at point ``i``.
+
+    The models whose parameters differ between the transforms are created
+    again with one value of each parameter per point. Returns None if a
+    varying parameter is not a scalar or belongs to a model which is not
+    in `ELEMENTWISE_MODELS`.
+    """
+    leaves = [_leaves(transform) for transform in transforms]
+    batched = []
+    for i, leaf in enumerate(leaves[0]):
+        values = dict((name, np.array([getattr(slit_leaves[i], name).value for slit_leaves in leaves]))
+                      for name in leaf.param_names)
+        if all((value == value[0]).all() for value in values.values()):
+            batched.append(leaf)
+            continue
+        if (type(leaf) not in ELEMENTWISE_MODELS or
+                any(value.ndim != 1 for value in values.values())):
+            return None
+        kwargs = _leaf_config(leaf)
+        kwargs.update((name, value[slit_ids]) for name, value in values.items())
+        try:
+            batched.append(type(leaf)(**kwargs))
+        except (TypeError, ValueError):
+            return None
+    return _replace_leaves(transforms[0], iter(batched))
+
+
+def _slit_batches(transforms, shapes, tile_pixels=TILE_PIXELS):
+    """
+    Return lists of indices of the slits evaluated together.
+
+    Slits are batched if their transforms have the same key and up to
+    ``tile_pixels`` pixels in total. Other slits are in a list of their own.
+    """
+    batches = []
+    groups = OrderedDict()
+    for index, (transform, shape) in enumerate(zip(transforms, shapes)):
+        key = _transform_key(transform)
+        npix = shape[1] * shape[2]
+        if key is None or npix >= tile_pixels:
+            batches.append([index])
+            continue
+        batch, size = groups.get(key, ([], 0))
+        if size + npix > tile_pixels:
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(index)
+        groups[key] = (batch, size + npix)
+    batches.extend(batch for batch, size in groups.values())
+    return batches
+
+
+def _write_batch(f, slits, offsets, shapes, frame, tile_pixels, dtype, with_bounding_box=True,
+                 transforms=None):
+    """ Evaluate the transforms of a batch of slits in one call and write them to ``f``."""
+    if len(slits) == 1:
+        _write_slit(f, slits[0], offsets[0], shapes[0], frame, tile_pixels, dtype, with_bounding_box)
+        return
+    if transforms is None:
+        transforms = [_slit_transform(slit, frame) for slit in slits]
+    valid = []
+    for slit, shape in zip(slits, shapes):
+        bbox = _slit_bounding_box(slit) if with_bounding_box else None
+        if bbox is None:
+            valid.append(np.ones(shape[1:], dtype=bool))
+        else:
+            valid.append(_valid_pixels(bbox, 0, shape[1], shape[2]))
+    sizes = [mask.sum() for mask in valid]
+    transform = _batched_transform(transforms, np.repeat(np.arange(len(slits)), sizes))
+    result = None
+    if transform is not None:
+        grids = [np.mgrid[: shape[1], : shape[2]] for shape in shapes]
+        y = np.concatenate([grid[0][mask] for grid, mask in zip(grids, valid)])
+        x = np.concatenate([grid[1][mask] for grid, mask in zip(grids, valid)])
+        try:
+            result = transform(x, y)
+        except (TypeError, ValueError):
+            result = None
+    if result is None:
+        for slit, offset, shape in zip(slits, offsets, shapes):
+            _write_slit(f, slit, offset, shape, frame, tile_pixels, dtype, with_bounding_box)
+        return
+    x, y, lam = result
+    start = 0
+    for offset, shape, mask, size in zip(offsets, shapes, valid, sizes):
+        planes = np.empty(shape)
+        planes.fill(np.nan)
+        planes[:, mask] = [lam[start: start + size], x[start: start + size], y[start: start + size]]
+        _write_rows(f, offset, shape, 0, planes, dtype)
+        start += size
+
+
+# The model opened by each worker process.
+_worker_model = None
+
+
+def _init_worker(fname):
+    global _worker_model
+    _worker_model = models.MultiSlitModel(fname)
+
+
+def _worker_write_batch(args):
+    """ Write a batch of slits of the worker's model; the WCS of other slits is not used."""
+    indices, output, offsets, shapes, frame, tile_pixels, dtype, with_bounding_box = args
+    slits = [_worker_model.slits[index] for index in indices]
+    with open(output, 'r+b') as f:
+        _write_batch(f, slits, offsets, shapes, frame, tile_pixels, dtype, with_bounding_box)
+
+
+def _compute_coordinates(fname, model, output, frame, plane_names, data, tile_pixels=TILE_PIXELS,
+                         workers=1, batch=False, dtype=np.float64, with_bounding_box=True):
+    """
+    Write the (lam, x, y) planes of the transform from the detector to
+    ``frame`` of each slit of ``model`` to ``output``.
+
+    With ``workers`` > 1 each process opens ``fname`` once and writes the
+    slits sent to it. The slits are written at the offsets of their
+    extensions, so the file does not depend on the order they are done.
+    With ``batch`` small slits sharing a transform are evaluated together.
+    With ``with_bounding_box`` only the pixels inside the bounding box of the
+    WCS of a slit are evaluated.
+    """
+    phdu = fits.PrimaryHDU()
+    phdu.header['filename'] = model.meta.filename
+    phdu.header['data'] = data
+    headers = []
+    shapes = []
+    for slit in model.slits:
+        shape = (3,) + slit.data.shape
+        header = _image_header(shape, dtype)
+        for i, name in enumerate(plane_names):
+            header['PLANE{0}'.format(i + 1)] = name
+        header['SLIT'] = slit.name
+        headers.append(header)
+        shapes.append(shape)
+
+    offsets = _create_file(output, phdu.header, headers, shapes, dtype)
+    transforms = None
+    if batch:
+        transforms = [_slit_transform(slit, frame) for slit in model.slits]
+        batches = _slit_batches(transforms, shapes, tile_pixels)
+    else:
+        batches = [[index] for index in range(len(shapes))]
+    if workers is None or workers <= 1 or len(batches) <= 1:
+        with open(output, 'r+b') as f:
+            for indices in batches:
+                _write_batch(f, [model.slits[index] for index in indices],
+                             [offsets[index] for index in indices],
+                             [shapes[index] for index in indices], frame, tile_pixels, dtype,
+                             with_bounding_box, transforms and [transforms[index] for index in indices])
+        return
+    jobs = [(indices, output, [offsets[index] for index in indices],
+             [shapes[index] for index in indices], frame, tile_pixels, dtype, with_bounding_box)
+            for indices in batches]
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=_init_worker,
+                             initargs=(fname,)) as executor:
+        list(executor.map(_worker_write_batch, jobs))
+
+
+def _convert(fitsfile, output, format='fits', compression=None):
+    """
+    Write the extensions of a file created by `_compute_coordinates` to a
+    tile compressed FITS file or an ASDF file with one block for each slit.
+
+    The input is memory mapped, so only one slit is in memory at a time.
+    """
+    with fits.open(fitsfile, memmap=True) as hdulist:
+        if format == 'fits':
+            hdus = [fits.PrimaryHDU(header=hdulist[0].header)]
+            for hdu in hdulist[1:]:
+                hdus.append(fits.CompImageHDU(hdu.data, header=hdu.header, compression_type=compression,
+                                              quantize_level=0))
+            fits.HDUList(hdus).writeto(output)
+            return
+        slits = []
+        for hdu in hdulist[1:]:
+            slits.append({'name': hdu.header['SLIT'],
+                          'planes': [hdu.header['PLANE{0}'.format(i)] for i in range(1, 4)],
+                          'data': hdu.data})
+        tree = {'filename': hdulist[0].header['FILENAME'], 'data': hdulist[0].header['DATA'],
+                'slits': slits}
+        kwargs = {'all_array_storage': 'internal'}
+        if compression is not None:
+            kwargs['all_array_compression'] = compression
+        asdf.AsdfFile(tree).write_to(output, **kwargs)
+
+
+def _write_coordinates(fname, output, suffix, frame, plane_names, data, tile_pixels=TILE_PIXELS,
+                       workers=1, batch=False, float32=False, format='fits', compression=None,
+                       with_bounding_box=True):
+    """
+    Compute the coordinates of all slits in ``fname`` and write them in ``format``.
+    """
+    if format not in FORMATS:
+        raise ValueError("format should be one of {0}".format(FORMATS))
+    allowed = FITS_COMPRESSION if format == 'fits' else COMPRESSION
+    if compression not in allowed:
+        raise ValueError("compression should be one of {0}".format(allowed))
+    dtype = np.float32 if float32 else np.float64
+
+    model = models.MultiSlitModel(fname)
+    output = _output_name(model, output, suffix, '.' + format)
+    if format == 'fits' and compression is None:
+        _compute_coordinates(fname, model, output, frame, plane_names, data, tile_pixels, workers,
+                             batch, dtype, with_bounding_box)
+        model.close()
+        return
+    if os.path.exists(output):
+        raise IOError("File {0} already exists.".format(output))
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        tmpfile = os.path.join(tmpdir, "coordinates.fits")
+        _compute_coordinates(fname, model, tmpfile, frame, plane_names, data, tile_pixels, workers,
+                             batch, dtype, with_bounding_box)
+        model.close()
+        _convert(tmpfile, output, format, compression)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def compute_world_coordinates(fname, output=None, tile_pixels=TILE_PIXELS, workers=1,
+                              float32=False, format='fits', compression=None, with_bounding_box=True):
     """
     Computes wavelengths, and space coordinates of a NIRSPEC
     fixed slit observation. For each slit the output is a cube
@@ -30,45 +531,33 @@ def compute_world_coordinates(fname, output=None):
     output : str
         The name of the output file. If None the root of the input
         file is used with an extension world_coordinates.
+    tile_pixels : int
+        Maximum number of pixels evaluated and kept in memory at once.
+        Slits are evaluated in blocks of rows of this size.
+    workers : int
+        Number of processes evaluating the slits.
+    float32 : bool
+        If True, write the planes as float32.
+    format : str
+        "fits" or "asdf". An ASDF file has one block for each slit.
+    compression : str, optional
+        Compression of the FITS extensions, "GZIP_1" or "GZIP_2" (lossless),
+        or of the ASDF blocks, "zlib", "bzp2" or "lz4".
+    with_bounding_box : bool
+        If True, only the pixels inside the bounding box of the slit WCS
+        are evaluated, the others are NaN.
 
     Examples
     --------
     >>> compute_world_coordinates('nrs1_fixed_assign_wcs_extract_2d.fits')
 
     """
-    model = models.MultiSlitModel(fname)
-    hdulist = fits.HDUList()
-    phdu = fits.PrimaryHDU()
-    phdu.header['filename'] = model.meta.filename
-    phdu.header['data'] = 'world coordinates'
-    hdulist.append(phdu)
-    for slit in model.slits:
-        ysize, xsize = slit.data.shape
-        y, x = np.mgrid[ : ysize, : xsize]
-        ra, dec, lam = slit.meta.wcs(x, y)
-        world_coordinates = np.array([lam, ra, dec])
-        imhdu = fits.ImageHDU(data=world_coordinates)
-        imhdu.header['PLANE1'] = 'lambda, microns'
-        imhdu.header['PLANE2'] = 'ote_x, arcsec'
-        imhdu.header['PLANE3'] = 'ote_y, arcsec'
-        imhdu.header['SLIT'] = slit.name
-        hdulist.append(imhdu)
-    if output is not None:
-        base, ext = os.path.splitext(output)
-        if ext != "fits":
-            ext = "fits"
-        if not base.endswith('world_coordinates'):
-            "".join([base, '_world_coordinates'])
-        "".join([base, ext])
-    else:
-        root = model.meta.filename.split('_')
-        output = "".join([root[0], '_world_coordinates', '.fits'])
-    hdulist.writeto(output)
-    del hdulist
-    model.close()
+    _write_coordinates(fname, output, 'world_coordinates', None, WORLD_PLANES, 'world coordinates',
+                       tile_pixels, workers, False, float32, format, compression, with_bounding_box)
 
 
-def compute_msa_coordinates(fname, output=None):
+def compute_msa_coordinates(fname, output=None, tile_pixels=TILE_PIXELS, workers=1, batch=True,
+                            float32=False, format='fits', compression=None, with_bounding_box=True):
     """
     Computes wavelengths, and relative MSA coordinates of a NIRSPEC
     fixed slit observation. For each slit the output is a cube
@@ -83,40 +572,29 @@ def compute_msa_coordinates(fname, output=None):
     output : str
         The name of the output file. If None the root of the input
         file is used with a suffix "msa".
+    tile_pixels : int
+        Maximum number of pixels evaluated and kept in memory at once.
+        Slits are evaluated in blocks of rows of this size.
+    workers : int
+        Number of processes evaluating the slits.
+    batch : bool
+        If True, small slits whose transforms differ only in parameter
+        values are evaluated in one call.
+    float32 : bool
+        If True, write the planes as float32.
+    format : str
+        "fits" or "asdf". An ASDF file has one block for each slit.
+    compression : str, optional
+        Compression of the FITS extensions, "GZIP_1" or "GZIP_2" (lossless),
+        or of the ASDF blocks, "zlib", "bzp2" or "lz4".
+    with_bounding_box : bool
+        If True, only the pixels inside the bounding box of the slit WCS
+        are evaluated, the others are NaN.
 
     Examples
     --------
     >>> compute_msa_coordinates('nrs1_fixed_assign_wcs_extract_2d.fits')
 
     """
-    model = models.MultiSlitModel(fname)
-    hdulist = fits.HDUList()
-    phdu = fits.PrimaryHDU()
-    phdu.header['filename'] = model.meta.filename
-    phdu.header['data'] = 'msa'
-    hdulist.append(phdu)
-    for slit in model.slits:
-        ysize, xsize = slit.data.shape
-        y, x = np.mgrid[ : ysize, : xsize]
-        det2msa = slit.meta.wcs.get_transform('detector', 'msa')
-        x, y, lam = det2msa(x, y)
-        msa_coordinates = np.array([lam, x, y])
-        imhdu = fits.ImageHDU(data=msa_coordinates)
-        imhdu.header['PLANE1'] = 'lambda, microns'
-        imhdu.header['PLANE2'] = 'msa_x, relative to center of slit (0, 0)'
-        imhdu.header['PLANE3'] = 'msa_y, relative to center of slit (0, 0)'
-        imhdu.header['SLIT'] = slit.name
-        hdulist.append(imhdu)
-    if output is not None:
-        base, ext = os.path.splitext(output)
-        if ext != "fits":
-            ext = "fits"
-        if not base.endswith('msa'):
-            "".join([base, '_msa'])
-        "".join([base, ext])
-    else:
-        root = model.meta.filename.split('_')
-        output = "".join([root[0], '_msa', '.fits'])
-    hdulist.writeto(output)
-    del hdulist
-    model.close()
+    _write_coordinates(fname, output, 'msa', 'msa', MSA_PLANES, 'msa', tile_pixels, workers, batch,
+                       float32, format, compression, with_bounding_box)
@@ -1,13 +1,15 @@
 import os.path
 import datetime
+from collections import OrderedDict
 import numpy as np
 from astropy.modeling import models
 
-from .utils import pcf2model
+from .utils import pcf2model, PcfDocument
+from .writer import write_reference
 from jwst.datamodels import DisperserModel
 from asdf.tags.core import Software, HistoryEntry
 
-__all__ = ["create_disperser_refs", "disperser2asdf"]
+__all__ = ["create_disperser_refs", "disperser2asdf", "GWATiltTable", "PrismIndex"]
 
 
 def disperser2asdf(disfile, tiltyfile, tiltxfile, author, description, useafter):
@@ -21,8 +23,8 @@ def disperser2asdf(disfile, tiltyfile, tiltxfile, author, description, useafter)
 
     Parameters
     ----------
-    disfile : list or str
-        A list of .dis files or a wild card string (*.dis).
+    disfile : str or `~jwreftools.nirspec.utils.PcfDocument`
+        A .dis or .pri file.
     tiltyfile : str
         File with tilt_Y data, e.g. disperser_G395H_TiltY.gtp.
     outname : str
@@ -34,15 +36,14 @@ def disperser2asdf(disfile, tiltyfile, tiltxfile, author, description, useafter)
 
     """
 
-    disperser = disfile.split('.dis')[0].split('_')[1]
-    with open(disfile) as f:
-        lines=[l.strip() for l in f.readlines()]
+    disfile = PcfDocument.read(disfile)
+    lines = disfile.lines
 
     try:
         ind = lines.index('*TYPE')
         disperser_type = (lines[ind + 1]).lower()
     except ValueError:
-        raise ValueError("Unknown disperser type in {0}".format(disfile))
+        raise ValueError("Unknown disperser type in {0}".format(disfile.filename))
 
     if disperser_type == 'gratingdata':
         d = dict.fromkeys(['groove_density', 'theta_z', 'theta_y', 'theta_x', 'tilt_y'])
@@ -171,11 +172,312 @@ def disperser_tilt(tiltfile):
     return tilt_d
 
 
-def create_disperser_refs(model_dir, author=None, description=None, useafter=None):
-    for i, grating in enumerate(["G140H", "G140M", "G235H", "G235M", "G395H",
-                                 "G395M", "MIRROR", "PRISM"]):
+class GWATiltTable(object):
+    """
+    Lookup table of a GWA tilt model on a uniform temperature grid.
+
+    The grid step is chosen so that linear interpolation is within
+    ``tolerance`` of the polynomial: the interpolation error of a function
+    with second derivative ``f''`` on a step ``h`` is at most
+    ``h**2 / 8 * max|f''|``. Temperatures outside the grid are evaluated
+    with the polynomial.
+
+    Parameters
+    ----------
+    tilt_model : `~astropy.modeling.models.Polynomial1D`
+        Tilt as a function of temperature, ``tilt_model`` in the dictionary
+        returned by `disperser_tilt`.
+    tmin, tmax : float
+        Temperature range of the table.
+    tolerance : float
+        Maximum interpolation error, in the units of the tilt.
+    cache_size : int
+        Number of temperatures remembered by `tilt`, the least recently
+        used are forgotten first.
+    decimals : int
+        Temperatures are rounded to ``decimals`` digits before the tilt is
+        evaluated, so that readings differing by less than the resolution
+        share one `tilt` entry and `tilt` and ``__call__`` agree.
+
+    Examples
+    --------
+    >>> tilt_d = disperser_tilt("disperser_G140H_TiltY.gtp")
+    >>> table = GWATiltTable.from_tilt(tilt_d)
+    >>> table.tilt(35.2)            # one exposure, memoized
+    >>> table(gwa_temperatures)     # many exposures at once
+    """
+    def __init__(self, tilt_model, tmin, tmax, tolerance=1e-9, cache_size=4096, decimals=6):
+        self.tilt_model = tilt_model
+        coeffs = np.asarray(tilt_model.parameters, dtype=np.float64)
+        self._coeffs = coeffs
+        second = np.polynomial.polynomial.polyder(coeffs, 2)
+        # max |f''| on the range, sampled densely and padded for safety
+        t = np.linspace(tmin, tmax, 1001)
+        curvature = np.abs(np.polynomial.polynomial.polyval(t, second)).max() * 1.01
+        if curvature > 0:
+            step = np.sqrt(8. * tolerance / curvature)
+            npoints = int(np.ceil((tmax - tmin) / step)) + 1
+        else:
+            npoints = 2
+        npoints = max(npoints, 2)
+        self.tmin = float(tmin)
+        self.tmax = float(tmax)
+        self.temperatures = np.linspace(tmin, tmax, npoints)
+        self.step = self.temperatures[1] - self.temperatures[0]
+        self.values = np.polynomial.polynomial.polyval(self.temperatures, coeffs)
+        self.error_bound = self.step ** 2 / 8. * curvature
+        self.cache_size = cache_size
+        self.decimals = decimals
+        self._memo = OrderedDict()
+
+    def __getstate__(self):
+        # The memoized values are not pickled, e.g. in a ModelCache or a process pool.
+        state = self.__dict__.copy()
+        state['_memo'] = OrderedDict()
+        return state
+
+    @classmethod
+    def from_tilt(cls, tilt_d, margin=5., **kwargs):
+        """
+        Create the table from the dictionary returned by `disperser_tilt`.
+
+        The temperature range covers the calibration temperatures extended
+        by ``margin`` on both sides.
+        """
+        temperatures = tilt_d['temperatures']
+        return cls(tilt_d['tilt_model'], min(temperatures) - margin,
+                   max(temperatures) + margin, **kwargs)
+
+    def tilt(self, temperature):
+        """
+        Return the tilt at a scalar ``temperature``, memoized.
+
+        The temperature is rounded to ``decimals`` digits. At most
+        ``cache_size`` values are kept, the least recently used is dropped.
+        """
+        temperature = float(np.round(float(temperature), self.decimals))
+        try:
+            self._memo.move_to_end(temperature)
+            return self._memo[temperature]
+        except KeyError:
+            pass
+        tilt = float(self(temperature))
+        self._memo[temperature] = tilt
+        if len(self._memo) > self.cache_size:
+            self._memo.popitem(last=False)
+        return tilt
+
+    def __call__(self, temperature):
+        """
+        Return the tilt at ``temperature`` (scalar or array).
+
+        The temperatures are rounded to ``decimals`` digits, as in `tilt`.
+        """
+        temperature = np.round(np.asarray(temperature, dtype=np.float64), self.decimals)
+        position = (temperature - self.tmin) / self.step
+        index = np.clip(np.floor(position).astype(np.intp), 0, len(self.values) - 2)
+        fraction = position - index
+        tilt = self.values[index] * (1. - fraction) + self.values[index + 1] * fraction
+        outside = (temperature < self.tmin) | (temperature > self.tmax)
+        if np.any(outside):
+            tilt = np.where(outside,
+                            np.polynomial.polynomial.polyval(temperature, self._coeffs), tilt)
+        return tilt
+
+
+class PrismIndex(object):
+    """
+    Refractive index of the PRISM as a function of wavelength and temperature.
+
+    The index of the glass at the reference temperature and pressure is given
+    by a Sellmeier equation with coefficients ``kcoef`` and ``lcoef``. Away
+    from the reference temperature a thermal correction with coefficients
+    ``tcoef`` = (D0, D1, D2, E0, E1, lambda_tk) is applied and the index is
+    made relative to the air at the operating pressure. This is the index used
+    by the pipeline with the values of a ``disperser`` reference file, computed
+    here for arrays of wavelengths and temperatures.
+
+    Parameters
+    ----------
+    kcoef, lcoef : list of 3 floats
+        Sellmeier coefficients.
+    tcoef : list of 6 floats
+        Thermal coefficients D0, D1, D2, E0, E1, lambda_tk.
+    tref : float
+        Reference temperature in K.
+    pref : float
+        Reference pressure in ATM.
+    """
+    def __init__(self, kcoef, lcoef, tcoef, tref, pref):
+        self.kcoef = np.asarray(kcoef, dtype=np.float64)
+        self.lcoef = np.asarray(lcoef, dtype=np.float64)
+        self.tcoef = np.asarray(tcoef, dtype=np.float64)
+        self.tref = float(tref)
+        self.pref = float(pref)
 
-        disperser_name =  "disperser_cv3_{0}.asdf".format(grating)
+    @classmethod
+    def from_disperser(cls, disperser):
+        """
+        Create the engine from a PRISM disperser model or dictionary.
+        """
+        if not isinstance(disperser, dict):
+            disperser = dict((key, getattr(disperser, key))
+                             for key in ['kcoef', 'lcoef', 'tcoef', 'tref', 'pref'])
+        return cls(disperser['kcoef'], disperser['lcoef'], disperser['tcoef'],
+                   disperser['tref'], disperser['pref'])
+
+    def _sellmeier(self, lam2):
+        n2 = 1.
+        for k, l in zip(self.kcoef, self.lcoef):
+            n2 = n2 + k * lam2 / (lam2 - l)
+        return np.sqrt(n2)
+
+    def __call__(self, lam, temperature, pressure=0.):
+        """
+        Evaluate the refractive index.
+
+        Parameters
+        ----------
+        lam : float or ndarray
+            Wavelength in m.
+        temperature : float or ndarray
+            Temperature in K.
+        pressure : float
+            Operating pressure in ATM.
+
+        Returns
+        -------
+        n : ndarray
+            Refractive index, broadcast over ``lam`` and ``temperature``.
+        """
+        lam = np.asarray(lam, dtype=np.float64) * 1e6  # in microns
+        temp = np.asarray(temperature, dtype=np.float64) - 273.15
+        tref = self.tref - 273.15
+        delt = temp - tref
+        lam, delt = np.broadcast_arrays(lam, delt)
+        temp = delt + tref
+        lam2 = lam ** 2
+
+        D0, D1, D2, E0, E1, lam_tk = self.tcoef
+        # Index of air at the reference and operating temperature and pressure
+        nref = 1. + (6432.8 + 2949810. * lam2 / (146.0 * lam2 - 1.) +
+                     5540.0 * lam2 / (41.0 * lam2 - 1.)) * 1e-8
+        nair_obs = 1.0 + (nref - 1.0) * pressure / (1.0 + (temp - 15.) * 3.4785e-3)
+        nair_ref = 1.0 + (nref - 1.0) * self.pref / (1.0 + (tref - 15.) * 3.4785e-3)
+
+        # Relative index of the glass at the reference temperature and pressure
+        lamrel2 = lam2 * (nair_obs / nair_ref) ** 2
+        nrel = self._sellmeier(lamrel2)
+        nabs_ref = nrel * nair_ref
+        # Absolute index of the glass at the operating temperature
+        delnabs = (0.5 * (nrel ** 2 - 1.) / nrel) * \
+            (D0 * delt + D1 * delt ** 2 + D2 * delt ** 3 +
+             (E0 * delt + E1 * delt ** 2) / (lamrel2 - lam_tk ** 2))
+        n = (nabs_ref + delnabs) / nair_obs
+        # Close to the reference temperature the Sellmeier equation is used directly.
+        near = delt < 20
+        if np.any(near):
+            n = np.where(near, self._sellmeier(lam2), n)
+        return n
+
+    def table(self, wavelength=None, temperature=None, pressure=0., wbound=None):
+        """
+        Tabulate the refractive index on a (wavelength, temperature) grid.
+
+        The table is not stored in the disperser reference file, it's built
+        when the file is loaded from the Sellmeier and thermal coefficients.
+
+        Parameters
+        ----------
+        wavelength : ndarray, optional
+            Uniform wavelength grid in m. Defaults to 2000 points within
+            ``wbound``.
+        temperature : ndarray, optional
+            Uniform temperature grid in K. Defaults to 20 K - 60 K in steps of 0.5 K.
+        pressure : float
+            Operating pressure in ATM.
+        wbound : list of 2 floats, optional
+            Wavelength range in m, used if ``wavelength`` is not given.
+
+        Returns
+        -------
+        table : dict
+            ``wavelength``, ``temperature`` and ``index`` of shape
+            (n_wavelength, n_temperature), the input of `PrismIndex.interpolate`.
+
+        Examples
+        --------
+        >>> disperser = DisperserModel("disperser_cv3_PRISM.asdf")
+        >>> table = PrismIndex.from_disperser(disperser).table(wbound=disperser.wbound)
+        >>> n = PrismIndex.interpolate(table, lam, temperature)
+        """
+        if wavelength is None:
+            if wbound is None:
+                raise ValueError("Expected a wavelength grid or wbound.")
+            wavelength = np.linspace(wbound[0], wbound[1], 2000)
+        if temperature is None:
+            temperature = np.arange(20., 60.25, 0.5)
+        wavelength = np.asarray(wavelength, dtype=np.float64)
+        temperature = np.asarray(temperature, dtype=np.float64)
+        index = self(wavelength[:, np.newaxis], temperature[np.newaxis, :], pressure)
+        return {'wavelength': wavelength, 'temperature': temperature, 'index': index}
+
+    @staticmethod
+    def interpolate(table, lam, temperature):
+        """
+        Bilinear interpolation in a table returned by `PrismIndex.table`.
+
+        The grids are uniform, so the cell of each point is found by index
+        arithmetic. Points outside the table are NaN.
+        """
+        wavelength = np.asarray(table['wavelength'])
+        temperatures = np.asarray(table['temperature'])
+        index = np.asarray(table['index'])
+        lam, temperature = np.broadcast_arrays(np.asarray(lam, dtype=np.float64),
+                                               np.asarray(temperature, dtype=np.float64))
+        u = (lam - wavelength[0]) / (wavelength[1] - wavelength[0])
+        v = (temperature - temperatures[0]) / (temperatures[1] - temperatures[0])
+        outside = (u < 0) | (u > len(wavelength) - 1) | (v < 0) | (v > len(temperatures) - 1)
+        i = np.clip(np.floor(u).astype(np.intp), 0, len(wavelength) - 2)
+        j = np.clip(np.floor(v).astype(np.intp), 0, len(temperatures) - 2)
+        fu = u - i
+        fv = v - j
+        n = (index[i, j] * (1 - fu) * (1 - fv) + index[i + 1, j] * fu * (1 - fv) +
+             index[i, j + 1] * (1 - fu) * fv + index[i + 1, j + 1] * fu * fv)
+        return np.where(outside, np.nan, n)
+
+
+GRATINGS = ["G140H", "G140M", "G235H", "G235M", "G395H", "G395M", "MIRROR", "PRISM"]
+
+
+def create_disperser_refs(model_dir, author=None, description=None, useafter=None,
+                          gratings=None, output_dir=".", write_options=None):
+    """
+    Create the DISPERSER reference files.
+
+    Parameters
+    ----------
+    model_dir : str
+        Directory with the NIRSPEC model.
+    author : str
+        Author field.
+    description : str
+        Consice description of the file.
+    useafter : str
+        A useafter date in ISO format.
+    gratings : list of str, optional
+        Gratings to create reference files for. Defaults to all of them.
+    output_dir : str
+        Directory where the reference files are written.
+    write_options : dict, optional
+        Arguments of `~jwreftools.nirspec.writer.write_reference`.
+        The arrays are written inline by default.
+    """
+    if gratings is None:
+        gratings = GRATINGS
+    for grating in gratings:
+
+        disperser_name = os.path.join(output_dir, "disperser_cv3_{0}.asdf".format(grating))
         if grating == 'PRISM':
             dis_file = "disperser_" + grating + ".pri"
         else:
@@ -186,38 +488,25 @@ def create_disperser_refs(model_dir, author=None, description=None, useafter=Non
         tilty_refname = os.path.join(model_dir, "Description", gtpy_file)
         tiltx_refname = os.path.join(model_dir, "Description", gtpx_file)
 
-        f = open(disp_refname)
-        lines = f.readlines()
-        lines = [l.strip() for l in lines]
-        f.close()
-        for i, line in enumerate(lines):
-            if 'AUTHOR' in line:
-                auth = lines[i + 1]
-                continue
-            elif 'DESCRIPTION' in line:
-                descrip = lines[i + 1]
-                continue
-            elif 'DATE' in line:
-                date = lines[i + 1]
-                continue
-
+        pcf = PcfDocument.read(disp_refname)
         if author is None:
-            file_author = auth
+            file_author = pcf.header['author']
         else:
             file_author = author
         if description is None:
-            file_description = descrip
+            file_description = pcf.header['description']
         else:
             file_description = description
         if useafter is None:
-            file_useafter = date
+            file_useafter = pcf.header['date']
         else:
             file_useafter = useafter
         try:
-            disperser_model = disperser2asdf(disp_refname, tilty_refname, tiltx_refname,
+            disperser_model = disperser2asdf(pcf, tilty_refname, tiltx_refname,
                                              file_author, file_description, file_useafter)
         except:
             raise Exception("Disperser file was not converted.")
         disperser_model.meta.instrument.grating = grating
-        disperser_model.to_asdf(disperser_name, all_array_storage="inline")
+        write_reference(disperser_model, disperser_name, reftype='disperser',
+                        **(write_options or {}))
         disperser_model.validate()
@@ -1,9 +1,10 @@
 import datetime
+import functools
 import os.path
 from asdf.tags.core import Software, HistoryEntry
 from astropy.modeling.models import Mapping, Identity
-from astropy.modeling import models
-from .utils import linear_from_pcf_det2sky, coeffs_from_pcf
+from .writer import write_reference
+from .utils import linear_from_pcf_det2sky, polynomial2d, PcfDocument, parallel_map
 
 from jwst.datamodels import FOREModel, IFUFOREModel
 
@@ -11,43 +12,74 @@ from jwst.datamodels import FOREModel, IFUFOREModel
 __all__ = ["create_fore_reference", "create_ifufore_reference", "fore2asdf"]
 
 
-def create_fore_reference(refdir, author=None, description=None, useafter=None):
+FILTERS = ["CLEAR", "F070LP", "F100LP", "F110W", "F140X", "F170LP", "F290LP"]
+
+
+def _read_fore(fore_refname, cache=None):
+    """ Read and convert one ``Fore_*.pcf`` file."""
+    pcf = PcfDocument.read(fore_refname, cache=cache)
+    try:
+        model = fore2asdf(pcf, name='fore', cache=cache)
+    except:
+        raise Exception(("FORE file was not created - {0}".format(fore_refname)))
+    return pcf.header, model
+
+
+def create_fore_reference(refdir, author=None, description=None, useafter=None, cache=None,
+                          filters=None, output_dir=".", workers=8, write_options=None):
+    """
+    Create the FORE reference files.
+
+    Parameters
+    ----------
+    refdir : str
+        Directory with the NIRSPEC model.
+    author : str
+        Author field.
+    description : str
+        Consice description of the file.
+    useafter : str
+        A useafter date in ISO format.
+    cache : `~jwreftools.nirspec.cache.ModelCache`, optional
+        Cache of parsed files and models.
+    filters : list of str, optional
+        Filters to create reference files for. Defaults to all of them.
+    output_dir : str
+        Directory where the reference files are written.
+    workers : int
+        Number of threads reading and converting the IDT files.
+    write_options : dict, optional
+        Arguments of `~jwreftools.nirspec.writer.write_reference`.
+    """
+    if filters is None:
+        filters = FILTERS
+    fore_refnames = [os.path.join(refdir, "CoordTransform", "Fore_{0}.pcf".format(filter))
+                     for filter in filters]
+    converted = parallel_map(functools.partial(_read_fore, cache=cache), fore_refnames,
+                             workers=workers)
     # fore reference file
-    for i, filter in enumerate(["CLEAR", "F070LP", "F100LP", "F110W", "F140X", "F170LP", "F290LP"]):
-        filename = "Fore_{0}.pcf".format(filter)
-        out_name = "fore_cv3_{0}.asdf".format(filter)
-        fore_refname = os.path.join(refdir, "CoordTransform", filename)
-        with open(fore_refname) as f:
-            lines = f.readlines()
-        lines = [l.strip() for l in lines]
-        for i, line in enumerate(lines):
-            if 'AUTHOR' in line:
-                auth = lines[i + 1]
-                continue
-            elif 'DESCRIPTION' in line:
-                descrip = lines[i + 1]
-                continue
-            elif 'DATE' in line:
-                date = lines[i + 1]
-                continue
+    for filter, (header, model) in zip(filters, converted):
+        out_name = os.path.join(output_dir, "fore_cv3_{0}.asdf".format(filter))
 
         if author is None:
-            author = auth
+            file_author = header['author']
+        else:
+            file_author = author
         if description is None:
-            description = descrip
+            file_description = header['description']
+        else:
+            file_description = description
         if useafter is None:
-            useafter = date
+            file_useafter = header['date']
+        else:
+            file_useafter = useafter
 
-        try:
-            model = fore2asdf(fore_refname, name='fore')
-        except:
-            raise Exception(("FORE file was not created - filter {0}".format(filter)))
         fore_model = FOREModel()
         fore_model.model = model
         fore_model.meta.pedigree = 'GROUND'
-        fore_model.meta.author = author
-        fore_model.meta.description = description
-        fore_model.meta.useafter = useafter
+        fore_model.meta.author = file_author
+        fore_model.meta.description = file_description
+        fore_model.meta.useafter = file_useafter
         fore_model.meta.instrument.filter = filter
 
         entry = HistoryEntry({'description': "New version created from CV3 with updated file structure", 'time': datetime.datetime.utcnow()})
@@ -55,25 +87,17 @@ def create_fore_reference(refdir, author=None, description=None, useafter=None):
                              'homepage': 'https://github.com/spacetelescope/jwreftools', 'version': "0.7.1"})
         entry['software'] = software
         fore_model.history.append(entry)
-        fore_model.to_asdf(out_name)
+        write_reference(fore_model, out_name, reftype='fore', **(write_options or {}))
         fore_model.validate()
 
 
-def create_ifufore_reference(ifufore_refname, out_name, author=None, description=None, useafter=None):
+def create_ifufore_reference(ifufore_refname, out_name, author=None, description=None, useafter=None,
+                             cache=None, write_options=None):
     #filename = "IFU_FORE.pcf"
-    with open(ifufore_refname) as f:
-        lines = f.readlines()
-    lines = [l.strip() for l in lines]
-    for i, line in enumerate(lines):
-        if 'AUTHOR' in line:
-            auth = lines[i + 1]
-            continue
-        elif 'DESCRIPTION' in line:
-            descrip = lines[i + 1]
-            continue
-        elif 'DATE' in line:
-            date = lines[i + 1]
-            continue
+    pcf = PcfDocument.read(ifufore_refname, cache=cache)
+    auth = pcf.header['author']
+    descrip = pcf.header['description']
+    date = pcf.header['date']
 
     if author is None:
         author = auth
@@ -82,7 +106,7 @@ def create_ifufore_reference(ifufore_refname, out_name, author=None, description
     if useafter is None:
         useafter = date
     try:
-        model = fore2asdf(ifufore_refname, name='ifufore')
+        model = fore2asdf(pcf, name='ifufore', cache=cache)
     except:
         print("IFUFORE file was not created.")
         raise
@@ -98,49 +122,45 @@ def create_ifufore_reference(ifufore_refname, out_name, author=None, description
                          'homepage': 'https://github.com/spacetelescope/jwreftools', 'version': "0.7.1"})
     entry['software'] = software
     ifufore_model.history.append(entry)
-    ifufore_model.to_asdf(out_name)
+    write_reference(ifufore_model, out_name, reftype='ifufore', **(write_options or {}))
     ifufore_model.validate()
 
 
-def fore2asdf(pcffore, name=""):
+def fore2asdf(pcffore, name="", cache=None):
     """
     forward direction : msa 2 ote
     backward_direction: msa 2 fpa
 
     """
-    with open(pcffore) as f:
-        lines = [l.strip() for l in f.readlines()]
+    pcf = PcfDocument.read(pcffore, cache=cache)
+    if cache is not None:
+        return cache.model(pcf, "fore2asdf-{0}".format(name),
+                           lambda: fore2asdf(pcf, name=name))
 
-    fore_det2sky = linear_from_pcf_det2sky(pcffore, name=name)
+    fore_det2sky = linear_from_pcf_det2sky(pcf, name=name)
     fore_linear = fore_det2sky
     fore_linear.inverse = fore_det2sky.inverse & Identity(1)
 
     # compute the polynomial
-    degree = int(lines[lines.index('*FitOrder') + 1])
+    degree = pcf.fit_order
 
-    xcoeff_index = lines.index('*xForwardCoefficients 21 2')
-    xlines = lines[xcoeff_index + 1: xcoeff_index + 22]
-    xcoeff_forward = coeffs_from_pcf(degree, xlines)
+    xcoeff_forward, xcoeff_forward_distortion = pcf.polynomial_coefficients(
+        'xForwardCoefficients', blocks=(0, 1))
     # Polynomial Correction in x
-    x_poly_backward = models.Polynomial2D(degree, name="{0}_x_back".format(name), **xcoeff_forward)
-    xlines_distortion = lines[xcoeff_index + 22: xcoeff_index + 43]
-    xcoeff_forward_distortion = coeffs_from_pcf(degree, xlines_distortion)
-    x_poly_backward_distortion = models.Polynomial2D(degree, name="{0}_x_backdist".format(name),
-                                                     **xcoeff_forward_distortion)
+    x_poly_backward = polynomial2d(degree, xcoeff_forward, name="{0}_x_back".format(name))
+    x_poly_backward_distortion = polynomial2d(degree, xcoeff_forward_distortion,
+                                              name="{0}_x_backdist".format(name))
     # do chromatic correction
     # the input is Xote, Yote, lam
     model_x_backward = (Mapping((0, 1), n_inputs=3) | x_poly_backward) + \
                      ((Mapping((0,1), n_inputs=3) | x_poly_backward_distortion) * \
                      (Mapping((2,)) | Identity(1)))
 
-    ycoeff_index = lines.index('*yForwardCoefficients 21 2')
-    ycoeff_forward = coeffs_from_pcf(degree, lines[ycoeff_index + 1: ycoeff_index + 22])
-    y_poly_backward = models.Polynomial2D(degree, name="{0}_y_back".format(name),  **ycoeff_forward)
-
-    ylines_distortion = lines[ycoeff_index + 22: ycoeff_index + 43]
-    ycoeff_forward_distortion = coeffs_from_pcf(degree, ylines_distortion)
-    y_poly_backward_distortion = models.Polynomial2D(degree, name="{0}_y_backdist".format(name),
-                                                     **ycoeff_forward_distortion)
+    ycoeff_forward, ycoeff_forward_distortion = pcf.polynomial_coefficients(
+        'yForwardCoefficients', blocks=(0, 1))
+    y_poly_backward = polynomial2d(degree, ycoeff_forward, name="{0}_y_back".format(name))
+    y_poly_backward_distortion = polynomial2d(degree, ycoeff_forward_distortion,
+                                              name="{0}_y_backdist".format(name))
 
     # do chromatic correction
     # the input is Xote, Yote, lam
@@ -148,13 +168,11 @@ def fore2asdf(pcffore, name=""):
                      ((Mapping((0, 1), n_inputs=3) | y_poly_backward_distortion) * \
                      (Mapping((2,)) | Identity(1) ))
 
-    xcoeff_index = lines.index('*xBackwardCoefficients 21 2')
-    xcoeff_backward = coeffs_from_pcf(degree, lines[xcoeff_index + 1: xcoeff_index + 22])
-    x_poly_forward = models.Polynomial2D(degree,name="{0}_x_forw".format(name), **xcoeff_backward)
-
-    xcoeff_backward_distortion = coeffs_from_pcf(degree, lines[xcoeff_index + 22: xcoeff_index + 43])
-    x_poly_forward_distortion = models.Polynomial2D(degree, name="{0}_x_forwdist".format(name),
-                                                    **xcoeff_backward_distortion)
+    xcoeff_backward, xcoeff_backward_distortion = pcf.polynomial_coefficients(
+        'xBackwardCoefficients', blocks=(0, 1))
+    x_poly_forward = polynomial2d(degree, xcoeff_backward, name="{0}_x_forw".format(name))
+    x_poly_forward_distortion = polynomial2d(degree, xcoeff_backward_distortion,
+                                             name="{0}_x_forwdist".format(name))
 
     # the chromatic correction is done here
     # the input is Xmsa, Ymsa, lam
@@ -162,13 +180,11 @@ def fore2asdf(pcffore, name=""):
                     ((Mapping((0,1), n_inputs=3) | x_poly_forward_distortion) * \
                     (Mapping((2,)) | Identity(1)))
 
-    ycoeff_index = lines.index('*yBackwardCoefficients 21 2')
-    ycoeff_backward = coeffs_from_pcf(degree, lines[ycoeff_index + 1: ycoeff_index + 22])
-    y_poly_forward = models.Polynomial2D(degree, name="{0}_y_forw".format(name), **ycoeff_backward)
-
-    ycoeff_backward_distortion = coeffs_from_pcf(degree, lines[ycoeff_index + 22: ycoeff_index + 43])
-    y_poly_forward_distortion = models.Polynomial2D(degree, name="{0}_y_forwdist".format(name),
-                                                    **ycoeff_backward_distortion)
+    ycoeff_backward, ycoeff_backward_distortion = pcf.polynomial_coefficients(
+        'yBackwardCoefficients', blocks=(0, 1))
+    y_poly_forward = polynomial2d(degree, ycoeff_backward, name="{0}_y_forw".format(name))
+    y_poly_forward_distortion = polynomial2d(degree, ycoeff_backward_distortion,
+                                             name="{0}_y_forwdist".format(name))
 
     # do chromatic correction
     # the input is Xmsa, Ymsa, lam
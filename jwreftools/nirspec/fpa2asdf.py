@@ -3,6 +3,8 @@ import numpy as np
 from jwst.datamodels import FPAModel
 from astropy.modeling import models
 from asdf.tags.core import HistoryEntry, Software
+from .utils import PcfDocument, affine_from_shifts
+from .writer import write_reference
 
 __all__ = ["create_fpa_reference", "fpa2asdf"]
 
@@ -24,48 +26,35 @@ def fpa2asdf(fpafile, author, description, useafter):
     outname : str
         Name of output ASDF file.
     """
-    with open(fpafile) as f:
-        lines = [l.strip() for l in f.readlines()]
+    fpa = PcfDocument.read(fpafile)
 
     # NRS1
-    ind = lines.index("*SCA491_PitchX")
-    nrs1_pitchx = float(lines[ind+1])
-    ind = lines.index("*SCA491_PitchY")
-    nrs1_pitchy = float(lines[ind+1])
-    ind = lines.index("*SCA491_RotAngle")
-    nrs1_angle = float(lines[ind+1])
-    ind = lines.index("*SCA491_PosX")
-    nrs1_posx = float(lines[ind+1])
-    ind = lines.index("*SCA491_PosY")
-    nrs1_posy = float(lines[ind+1])
+    nrs1_pitchx = float(fpa.value("SCA491_PitchX"))
+    nrs1_pitchy = float(fpa.value("SCA491_PitchY"))
+    nrs1_angle = float(fpa.value("SCA491_RotAngle"))
+    nrs1_posx = float(fpa.value("SCA491_PosX"))
+    nrs1_posy = float(fpa.value("SCA491_PosY"))
 
     # NRS2
-    ind = lines.index("*SCA492_PitchX")
-    nrs2_pitchx = float(lines[ind+1])
-    ind = lines.index("*SCA492_PitchY")
-    nrs2_pitchy = float(lines[ind+1])
-    ind = lines.index("*SCA492_RotAngle")
-    nrs2_angle = float(lines[ind+1])
-    ind = lines.index("*SCA492_PosX")
-    nrs2_posx = float(lines[ind+1])
-    ind = lines.index("*SCA492_PosY")
-    nrs2_posy = float(lines[ind+1])
+    nrs2_pitchx = float(fpa.value("SCA492_PitchX"))
+    nrs2_pitchy = float(fpa.value("SCA492_PitchY"))
+    nrs2_angle = float(fpa.value("SCA492_RotAngle"))
+    nrs2_posx = float(fpa.value("SCA492_PosX"))
+    nrs2_posy = float(fpa.value("SCA492_PosY"))
 
     # NRS1 Sky to Detector
     scaling = np.array([[1/nrs1_pitchx, 0], [0, 1/nrs1_pitchy]])
     rotmat = models.Rotation2D._compute_matrix(-nrs1_angle)
     matrix = np.dot(scaling, rotmat)
-    aff = models.AffineTransformation2D(matrix, name='fpa_affine_s2d')
-    nrs1_sky2det = models.Shift(-nrs1_posx, name='fpa_x_s2d') & \
-        models.Shift(-nrs1_posy, name='fpa_y_s2d') | aff
+    nrs1_sky2det = affine_from_shifts(matrix, pre_shift=(-nrs1_posx, -nrs1_posy),
+                                      name='fpa_affine_s2d')
 
     # NRS1 Detector to Sky
     rotmat = models.Rotation2D._compute_matrix(-nrs1_angle)
     scaling = np.array([[nrs1_pitchx, 0], [0, nrs1_pitchy]])
     matrix = np.dot(rotmat, scaling)
-    aff = models.AffineTransformation2D(matrix, name='fpa_affine_d2s')
-    nrs1_det2sky = aff | models.Shift(nrs1_posx, name='fpa_x_d2s') & \
-        models.Shift(nrs1_posy, name='fpa_y_d2s')
+    nrs1_det2sky = affine_from_shifts(matrix, post_shift=(nrs1_posx, nrs1_posy),
+                                      name='fpa_affine_d2s')
 
     nrs1_det2sky.inverse = nrs1_sky2det
 
@@ -73,17 +62,15 @@ def fpa2asdf(fpafile, author, description, useafter):
     scaling = np.array([[-1/nrs2_pitchx, 0], [0, -1/nrs2_pitchy]])
     rotmat = models.Rotation2D._compute_matrix(-nrs2_angle)
     matrix = np.dot(scaling, rotmat)
-    aff = models.AffineTransformation2D(matrix, name='fpa_affine_s2d')
-    nrs2_sky2det = models.Shift(-nrs2_posx, name='fpa_x_s2d') & \
-        models.Shift(-nrs2_posy, name='fpa_y_s2d') | aff
+    nrs2_sky2det = affine_from_shifts(matrix, pre_shift=(-nrs2_posx, -nrs2_posy),
+                                      name='fpa_affine_s2d')
 
     # NRS2 Detector to Sky
     rotmat = models.Rotation2D._compute_matrix(nrs2_angle)
     scaling = np.array([[-nrs2_pitchx, 0], [0, -nrs2_pitchy]])
     matrix = np.dot(scaling, rotmat)
-    aff = models.AffineTransformation2D(matrix, name='fpa_affine_d2s')
-    nrs2_det2sky = aff | models.Shift(nrs2_posx, name='fpa_x_d2s') &  \
-        models.Shift(nrs2_posy, name='fpa_y_d2s')
+    nrs2_det2sky = affine_from_shifts(matrix, post_shift=(nrs2_posx, nrs2_posy),
+                                      name='fpa_affine_d2s')
 
     nrs2_det2sky.inverse = nrs2_sky2det
 
@@ -97,20 +84,12 @@ def fpa2asdf(fpafile, author, description, useafter):
 
     return fpa_model
 
-def create_fpa_reference(fpa_refname, out_name, author=None, description=None, useafter=None):
-    with open(fpa_refname) as f:
-        lines = f.readlines()
-        lines = [l.strip() for l in lines]
-    for i, line in enumerate(lines):
-        if 'AUTHOR' in line:
-            auth = lines[i + 1]
-            continue
-        elif 'DESCRIPTION' in line:
-            descrip = lines[i + 1]
-            continue
-        elif 'DATE' in line:
-            date = lines[i + 1]
-            continue
+def create_fpa_reference(fpa_refname, out_name, author=None, description=None, useafter=None,
+                         write_options=None):
+    fpa = PcfDocument.read(fpa_refname)
+    auth = fpa.header['author']
+    descrip = fpa.header['description']
+    date = fpa.header['date']
 
     if author is None:
         author = auth
@@ -120,7 +99,7 @@ def create_fpa_reference(fpa_refname, out_name, author=None, description=None, u
         useafter = date
 
     try:
-        model = fpa2asdf(fpa_refname, author, description, useafter)
+        model = fpa2asdf(fpa, author, description, useafter)
     except:
         raise
     entry = HistoryEntry({'description': "New version created from CV3 with updated file structure", 'time': datetime.datetime.utcnow()})
@@ -128,7 +107,7 @@ def create_fpa_reference(fpa_refname, out_name, author=None, description=None, u
                          'homepage': 'https://github.com/spacetelescope/jwreftools', 'version': "0.7.1"})
     entry['software'] = software
     model.history.append(entry)
-    model.to_asdf(out_name)
+    write_reference(model, out_name, reftype='fpa', **(write_options or {}))
     model.validate()
 
 
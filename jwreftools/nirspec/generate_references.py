@@ -1,47 +1,304 @@
+import glob
 import os.path
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
 from . import *
+from .cache import ModelCache
+from .disperser2asdf import GRATINGS
+from .fore2asdf import FILTERS
+from .manifest import Manifest, MANIFEST_NAME
 
 model_dir = "/internal/1/astropy/jwreftools/cv3"
 
 
-def generate(model_dir):
+Task = namedtuple('Task', ['reftype', 'output', 'func', 'args', 'kwargs', 'inputs'])
+"""
+One reference file to create: ``func(*args, **kwargs)`` writes ``output``
+from the files in ``inputs``.
+"""
+
+
+def reference_tasks(model_dir, output_dir=".", cache=None, write_options=None, keywords=None):
+    """
+    Return the list of reference files created from the NIRSPEC model.
+
+    The tasks are independent of each other and can be run in any order.
+
+    Parameters
+    ----------
+    model_dir : str
+        Directory with the NIRSPEC model.
+    output_dir : str
+        Directory where the reference files are written.
+    cache : `~jwreftools.nirspec.cache.ModelCache`, optional
+        Cache of parsed IDT files.
+    write_options : dict, optional
+        {reftype: arguments of `~jwreftools.nirspec.writer.write_reference`}
+    keywords : dict, optional
+        ``author``, ``description`` and ``useafter`` passed to all converters,
+        as given; `generate` leaves out the values not set by the caller.
+
+    Returns
+    -------
+    tasks : list of `Task`
+    """
+    keywords = keywords or {}
+    tasks = []
+
+    def out(name):
+        return os.path.join(output_dir, name)
+
     # Create FPA file
     fpa_refname = os.path.join(model_dir, "Description", "FPA.fpa")
-    create_fpa_reference(fpa_refname, "nirspec_cv3_fpa.asdf")
+    tasks.append(Task('fpa', out("nirspec_cv3_fpa.asdf"), create_fpa_reference,
+                      (fpa_refname, out("nirspec_cv3_fpa.asdf")), dict(keywords),
+                      [fpa_refname]))
 
     # Create CAMERA file
     camera_refname = os.path.join(model_dir, "CoordTransform", "Camera.pcf")
-    create_camera_reference(camera_refname, "nirspec_cv3_camera.asdf")
+    tasks.append(Task('camera', out("nirspec_cv3_camera.asdf"), create_camera_reference,
+                      (camera_refname, out("nirspec_cv3_camera.asdf")), dict(keywords, cache=cache),
+                      [camera_refname]))
 
     # Create COLLIMATOR file
     collimator_refname = os.path.join(model_dir, "CoordTransform", "Collimator.pcf")
-    create_collimator_reference(collimator_refname, "nirspec_cv3_collimator.asdf")
+    tasks.append(Task('collimator', out("nirspec_cv3_collimator.asdf"), create_collimator_reference,
+                      (collimator_refname, out("nirspec_cv3_collimator.asdf")),
+                      dict(keywords, cache=cache), [collimator_refname]))
 
     # Create DISPERSER files
-    create_disperser_refs(model_dir)
+    for grating in GRATINGS:
+        ext = ".pri" if grating == "PRISM" else ".dis"
+        inputs = [os.path.join(model_dir, "Description", "disperser_" + grating + suffix)
+                  for suffix in [ext, "_TiltY.gtp", "_TiltX.gtp"]]
+        tasks.append(Task('disperser', out("disperser_cv3_{0}.asdf".format(grating)),
+                          create_disperser_refs, (model_dir,),
+                          dict(keywords, gratings=[grating], output_dir=output_dir), inputs))
 
     # Create FORE files
-    create_fore_reference(model_dir)
+    for filter in FILTERS:
+        fore_refname = os.path.join(model_dir, "CoordTransform", "Fore_{0}.pcf".format(filter))
+        tasks.append(Task('fore', out("fore_cv3_{0}.asdf".format(filter)), create_fore_reference,
+                          (model_dir,),
+                          dict(keywords, cache=cache, filters=[filter], output_dir=output_dir),
+                          [fore_refname]))
 
     # Create IFUFORE file
     ifufore_refname = os.path.join(model_dir, "CoordTransform", "IFU", "IFU_FORE.pcf")
-    create_ifufore_reference(ifufore_refname, "nirspec_cv3_ifufore.asdf")
+    tasks.append(Task('ifufore', out("nirspec_cv3_ifufore.asdf"), create_ifufore_reference,
+                      (ifufore_refname, out("nirspec_cv3_ifufore.asdf")),
+                      dict(keywords, cache=cache), [ifufore_refname]))
 
     # Create OTE file
     ote_refname = os.path.join(model_dir, "CoordTransform", "OTE.pcf")
-    create_ote_reference(ote_refname, "nirspec_cv3_ote.asdf")
+    tasks.append(Task('ote', out("nirspec_cv3_ote.asdf"), create_ote_reference,
+                      (ote_refname, out("nirspec_cv3_ote.asdf")), dict(keywords), [ote_refname]))
 
     # Create IFUSLICER file
     ifuslicer_refname = os.path.join(model_dir, "Description", "IFU_slicer.sgd")
-    create_ifuslicer_reference(ifuslicer_refname, "nirspec_cv3_ifuslicer.asdf")
+    tasks.append(Task('ifuslicer', out("nirspec_cv3_ifuslicer.asdf"), create_ifuslicer_reference,
+                      (ifuslicer_refname, out("nirspec_cv3_ifuslicer.asdf")), dict(keywords),
+                      [ifuslicer_refname]))
 
     # Create IFUPOST file
-    create_ifupost_reference(model_dir, "nirspec_cv3_ifupost.asdf")
+    ifupost_list = sorted(glob.glob(os.path.join(model_dir, "CoordTransform", "IFU", "IFU-POST*")))
+    tasks.append(Task('ifupost', out("nirspec_cv3_ifupost.asdf"), create_ifupost_reference,
+                      (model_dir, out("nirspec_cv3_ifupost.asdf")), dict(keywords, cache=cache),
+                      ifupost_list))
 
     # Create MSA file
     msa_refname = os.path.join(model_dir, "Description", "MSA.msa")
-    create_msa_reference(msa_refname, "nirspec_cv3_msa.asdf")
+    tasks.append(Task('msa', out("nirspec_cv3_msa.asdf"), create_msa_reference,
+                      (msa_refname, out("nirspec_cv3_msa.asdf")), dict(keywords), [msa_refname]))
 
     # Create WAVELENGTHRANGE file
     wrange_refname = os.path.join(model_dir, "spectralconfigurations_rev1.2.txt")
-    create_wavelengthrange_reference(wrange_refname, "nirspec_cv3_wavelengthrange.asdf")
+    tasks.append(Task('wavelengthrange', out("nirspec_cv3_wavelengthrange.asdf"),
+                      create_wavelengthrange_reference,
+                      (wrange_refname, out("nirspec_cv3_wavelengthrange.asdf")), dict(keywords),
+                      [wrange_refname]))
+
+    if write_options:
+        for task in tasks:
+            if task.reftype in write_options:
+                task.kwargs['write_options'] = write_options[task.reftype]
+    return tasks
+
+
+def reference_types():
+    """
+    Return the reference types created by `generate`, in the order of `reference_tasks`.
+    """
+    reftypes = []
+    for task in reference_tasks(""):
+        if task.reftype not in reftypes:
+            reftypes.append(task.reftype)
+    return reftypes
+
+
+def run_task(task):
+    """
+    Run a task.
+
+    Returns
+    -------
+    result : tuple
+        (elapsed time, None) on success or (elapsed time, formatted traceback).
+    """
+    start = time.time()
+    try:
+        task.func(*task.args, **task.kwargs)
+    except Exception:
+        return time.time() - start, traceback.format_exc()
+    return time.time() - start, None
+
+
+def run_tasks(tasks, jobs=1):
+    """
+    Run tasks, in a pool of ``jobs`` processes if ``jobs`` > 1.
+
+    All tasks are run, even if some of them fail.
+
+    Returns
+    -------
+    results : list of tuple
+        The result of `run_task` for each task, in the order of ``tasks``.
+    """
+    if jobs is None or jobs <= 1:
+        return [run_task(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(run_task, tasks))
+
+
+def report(tasks, results, reasons=None):
+    """
+    Print a summary of the tasks and return the failed ones.
+
+    Parameters
+    ----------
+    tasks : list of `Task`
+    results : list
+        Results of `run_task`, None for tasks which were not run.
+    reasons : list of str, optional
+        Why each task was run.
+    """
+    if reasons is None:
+        reasons = [""] * len(tasks)
+    failed = []
+    nrun = 0
+    for task, result, reason in zip(tasks, results, reasons):
+        output = os.path.basename(task.output)
+        if result is None:
+            print("{0:<16} {1:<40} {2:>9}  up to date".format(task.reftype, output, ""))
+            continue
+        nrun += 1
+        elapsed, error = result
+        status = "ok" if error is None else "FAILED"
+        print("{0:<16} {1:<40} {2:>8.2f}s  {3:<6} {4}".format(
+            task.reftype, output, elapsed, status, reason))
+        if error is not None:
+            failed.append((task, error))
+    print("{0} of {1} reference files created, {2} up to date.".format(
+        nrun - len(failed), nrun, len(tasks) - nrun))
+    for task, error in failed:
+        print("\n{0} was not created:\n{1}".format(task.output, error))
+    return failed
+
+
+def generate(model_dir, cache=None, jobs=1, force=False, author=None, description=None,
+             useafter=None, output_dir=".", reftypes=None, dry_run=False, write_options=None):
+    """
+    Create all NIRSPEC reference files from the IDT model.
+
+    A manifest, ``nirspec_manifest.json``, records the inputs of each reference
+    file. On the next run only the files whose inputs, keywords or converter
+    version changed are created again.
+
+    Parameters
+    ----------
+    model_dir : str
+        Directory with the NIRSPEC model.
+    cache : `~jwreftools.nirspec.cache.ModelCache` or str, optional
+        A cache of parsed IDT files, or the name of its directory.
+        Files which have not changed since the previous run are not parsed again.
+    jobs : int
+        Number of processes creating reference files in parallel.
+        The output file names do not depend on ``jobs``.
+    force : bool
+        If True, create all reference files, even if they are up to date.
+    author, description, useafter : str, optional
+        Override the values read from the IDT files.
+    output_dir : str
+        Directory where the reference files and the manifest are written.
+    reftypes : list of str, optional
+        Create only these reference types, e.g. ``['fore', 'msa']``.
+        Defaults to all of them.
+    dry_run : bool
+        If True, print the reference files which would be created and return.
+    write_options : dict, optional
+        {reftype: arguments of `~jwreftools.nirspec.writer.write_reference`},
+        e.g. ``{'msa': {'compression': 'zlib'}}``.
+
+    Returns
+    -------
+    tasks : list of `Task`
+        The tasks which were run, or would be run if ``dry_run`` is True.
+    """
+    if isinstance(cache, str):
+        cache = ModelCache(cache)
+
+    # Only the keywords set by the caller are passed and recorded, the
+    # converters use their own defaults for the others.
+    keywords = dict((key, value) for key, value in
+                    [('author', author), ('description', description), ('useafter', useafter)]
+                    if value is not None)
+    tasks = reference_tasks(model_dir, output_dir=output_dir, cache=cache,
+                            write_options=write_options, keywords=keywords)
+    if reftypes is not None:
+        unknown = set(reftypes) - set(task.reftype for task in tasks)
+        if unknown:
+            raise ValueError("Unknown reference types: {0}".format(", ".join(sorted(unknown))))
+        tasks = [task for task in tasks if task.reftype in reftypes]
+
+    manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME))
+    task_keywords = []
+    reasons = []
+    for task in tasks:
+        # The write options change the output, so they are recorded like the keywords.
+        kw = dict(keywords)
+        if 'write_options' in task.kwargs:
+            kw['write_options'] = task.kwargs['write_options']
+        task_keywords.append(kw)
+        reasons.append("forced" if force else manifest.outdated(task.output, task.inputs, kw))
+    todo = [task for task, reason in zip(tasks, reasons) if reason is not None]
+
+    if dry_run:
+        for task, reason in zip(tasks, reasons):
+            print("{0:<16} {1:<40} {2}".format(task.reftype, os.path.basename(task.output),
+                                               reason or "up to date"))
+        print("{0} of {1} reference files would be created.".format(len(todo), len(tasks)))
+        return todo
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    start = time.time()
+    results = iter(run_tasks(todo, jobs=jobs))
+    all_results = [next(results) if reason is not None else None for reason in reasons]
+    for task, result, kw in zip(tasks, all_results, task_keywords):
+        if result is None:
+            continue
+        if result[1] is None:
+            manifest.record(task.output, task.inputs, kw)
+        else:
+            manifest.remove(task.output)
+    manifest.write()
+
+    failed = report(tasks, all_results, reasons)
+    print("Total time {0:.2f}s with {1} job(s).".format(time.time() - start, jobs))
+    if failed:
+        raise RuntimeError("{0} reference files were not created: {1}".format(
+            len(failed), ", ".join(os.path.basename(task.output) for task, error in failed)))
+    return todo
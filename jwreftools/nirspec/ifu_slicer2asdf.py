@@ -1,9 +1,9 @@
 import datetime
 import os.path
 import numpy as np
-from astropy.modeling import models
-from astropy.io import fits
 from jwst.datamodels import IFUSlicerModel
+from .utils import rotation_shift, fits_input
+from .writer import write_reference
 from asdf.tags.core import Software, HistoryEntry
 
 
@@ -18,19 +18,19 @@ def ifu_slicer2asdf(ifuslicer, author, description, useafter):
 
     Parameters
     ----------
-    ifuslicer : str
-        A fits file with the IFU slicer description
+    ifuslicer : str or `~astropy.io.fits.HDUList`
+        A fits file with the IFU slicer description. The table is a memory
+        mapped view of the file; pass an open file to keep it open until
+        the reference file is written.
     outname : str
         Name of output ASDF file.
     """
-    f = fits.open(ifuslicer)
-    data = f[1].data
-    header = f[1].header
-    shiftx = models.Shift(header['XREF'], name='ifuslicer_x')
-    shifty = models.Shift(header['YREF'], name='ifuslicer_y')
-    rot = models.Rotation2D(np.rad2deg(header['ROT']), name='ifuslicer_rotate')
-    model = rot | shiftx & shifty
-    f.close()
+    with fits_input(ifuslicer) as f:
+        data = f[1].data
+        header = f[1].header
+        # Rotation2D | Shift & Shift folded in one affine transform
+        model = rotation_shift(np.rad2deg(header['ROT']), header['XREF'], header['YREF'],
+                               name='ifuslicer')
 
     slicer_model = IFUSlicerModel()
     slicer_model.model = model
@@ -42,26 +42,29 @@ def ifu_slicer2asdf(ifuslicer, author, description, useafter):
     return slicer_model
 
 
-def create_ifuslicer_reference(ifuslicer_refname, output_name, author=None, description=None, useafter=None):
-    with fits.open(ifuslicer_refname) as f:
+def create_ifuslicer_reference(ifuslicer_refname, output_name, author=None, description=None, useafter=None,
+                               write_options=None):
+    # The file is opened once, memory mapped, and kept open until the
+    # table is written to the reference file.
+    with fits_input(ifuslicer_refname) as f:
         auth = f[0].header['AUTHOR']
         descrip = f[0].header['DESCR']
         date = f[0].header['DATE']
-    if author is None:
-        author = auth
-    if description is None:
-        description = descrip
-    if useafter is None:
-        useafter = date
+        if author is None:
+            author = auth
+        if description is None:
+            description = descrip
+        if useafter is None:
+            useafter = date
 
-    try:
-        model = ifu_slicer2asdf(ifuslicer_refname, author, description, useafter)
-    except:
-        raise Exception("IFUSLICER file was not created.")
-    entry = HistoryEntry({'description': "New version created from CV3 with updated file structure", 'time': datetime.datetime.utcnow()})
-    software = Software({'name': 'jwstreftools', 'author': 'N.Dencheva',
-                         'homepage': 'https://github.com/spacetelescope/jwreftools', 'version': "0.7.1"})
-    entry['software'] = software
-    model.history.append(entry)
-    model.to_asdf(output_name)
-    model.validate()
+        try:
+            model = ifu_slicer2asdf(f, author, description, useafter)
+        except:
+            raise Exception("IFUSLICER file was not created.")
+        entry = HistoryEntry({'description': "New version created from CV3 with updated file structure", 'time': datetime.datetime.utcnow()})
+        software = Software({'name': 'jwstreftools', 'author': 'N.Dencheva',
+                             'homepage': 'https://github.com/spacetelescope/jwreftools', 'version': "0.7.1"})
+        entry['software'] = software
+        model.history.append(entry)
+        write_reference(model, output_name, reftype='ifuslicer', **(write_options or {}))
+        model.validate()
@@ -1,15 +1,223 @@
 import datetime
+import functools
 import os.path, glob
+import numpy as np
 from asdf.tags.core import Software, HistoryEntry
-from astropy.modeling import models
-from astropy.modeling.models import Mapping, Identity
 from jwst.datamodels import IFUPostModel
-from .utils import coeffs_from_pcf, homothetic_sky2det
+from .writer import write_reference
+from .utils import polynomial2d, homothetic_sky2det, PcfDocument, poly2d_terms, parallel_map
+from .polynomial import evaluate_polynomials
 
-__all__ = ["create_ifupost_reference", "ifupost2asdf"]
+__all__ = ["create_ifupost_reference", "ifupost2asdf", "ifupost_slice", "IFUPostStack"]
 
 
-def ifupost2asdf(ifupost_files, author, description, useafter):
+def ifupost_slice(pcffile):
+    """
+    Create the models of one ``IFU-POST`` slice.
+
+    Parameters
+    ----------
+    pcffile : str or `~jwreftools.nirspec.utils.PcfDocument`
+        An IDT ``IFU-POST_N.pcf`` file.
+
+    Returns
+    -------
+    model : dict
+        The linear and polynomial transforms of the slice.
+    """
+    pcf = PcfDocument.read(pcffile)
+    linear_sky2det = homothetic_sky2det(pcf.input_rotation_centre, pcf.rotation, pcf.factors,
+                                        pcf.output_rotation_centre, name='ifupost')
+
+    degree = pcf.fit_order
+
+    xcoeff_forward, xcoeff_forward_distortion = pcf.polynomial_coefficients(
+        'xForwardCoefficients', blocks=(0, 1))
+    x_poly_forward = polynomial2d(degree, xcoeff_forward, name='ifupost_x_forw')
+    x_poly_forward_distortion = polynomial2d(degree, xcoeff_forward_distortion,
+                                             name="ifupost_x_forwdist")
+
+    ycoeff_forward, ycoeff_forward_distortion = pcf.polynomial_coefficients(
+        'yForwardCoefficients', blocks=(0, 1))
+    y_poly_forward = polynomial2d(degree, ycoeff_forward, name='ifupost_y_forw')
+    y_poly_forward_distortion = polynomial2d(degree, ycoeff_forward_distortion,
+                                             name="ifupost_y_forwdist")
+
+    xcoeff_backward, = pcf.polynomial_coefficients('xBackwardCoefficients')
+    x_poly_backward = polynomial2d(degree, xcoeff_backward, name='ifupost_x_back')
+
+    ycoeff_backward, = pcf.polynomial_coefficients('yBackwardCoefficients')
+    y_poly_backward = polynomial2d(degree, ycoeff_backward, name='ifupost_y_back')
+
+    x_poly_forward.inverse = x_poly_backward
+    y_poly_forward.inverse = y_poly_backward
+
+    model = {'linear': linear_sky2det,
+             'xpoly': x_poly_forward,
+             'xpoly_distortion': x_poly_forward_distortion,
+             'ypoly': y_poly_forward,
+             'ypoly_distortion': y_poly_forward_distortion
+             }
+    return model
+
+
+def _slice_number(filename):
+    """ Return N from the name of an ``IFU-POST_N.pcf`` file."""
+    fname = os.path.split(filename)[1]
+    return int((fname.split('IFU-POST_')[1]).split('.pcf')[0])
+
+
+def _read_slice(filename, cache=None):
+    """ Read and convert one ``IFU-POST`` file; return (slice number, models)."""
+    pcf = PcfDocument.read(filename, cache=cache)
+    if cache is not None:
+        model = cache.model(pcf, "ifupost-slice", lambda: ifupost_slice(pcf))
+    else:
+        model = ifupost_slice(pcf)
+    return _slice_number(filename), model
+
+
+class IFUPostStack(object):
+    """
+    All ``IFU-POST`` slices stacked in arrays.
+
+    Each slice transforms (x, y, lam) as::
+
+        xl, yl = matrix @ (x, y) + translation
+        x' = xpoly(xl, yl) + xpoly_distortion(xl, yl) * lam
+        y' = ypoly(xl, yl) + ypoly_distortion(xl, yl) * lam
+
+    which is the transform the pipeline builds from each ``slice_N`` of the
+    ``ifupost`` reference file. Here the parameters of all slices are stored
+    in arrays and points from any mix of slices are evaluated in one call.
+
+    Parameters
+    ----------
+    slices : list of int
+        Slice numbers.
+    degree : int
+        Degree of the polynomials.
+    matrix : ndarray of shape (n_slices, 2, 2)
+        Matrices of the linear transforms.
+    translation : ndarray of shape (n_slices, 2)
+        Translations of the linear transforms.
+    coeffs : ndarray of shape (4, n_slices, n_coeffs)
+        Coefficients of xpoly, xpoly_distortion, ypoly and ypoly_distortion
+        in the order of the `~astropy.modeling.models.Polynomial2D` parameters.
+    """
+    terms = ['xpoly', 'xpoly_distortion', 'ypoly', 'ypoly_distortion']
+
+    def __init__(self, slices, degree, matrix, translation, coeffs):
+        self.slices = np.asarray(slices, dtype=np.intp)
+        self.degree = degree
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self.translation = np.asarray(translation, dtype=np.float64)
+        self.coeffs = np.asarray(coeffs, dtype=np.float64)
+        nslices = len(self.slices)
+        ncoeffs = (degree + 1) * (degree + 2) // 2
+        if self.matrix.shape != (nslices, 2, 2) or self.translation.shape != (nslices, 2):
+            raise ValueError("Expected linear parameters for {0} slices.".format(nslices))
+        if self.coeffs.shape != (4, nslices, ncoeffs):
+            raise ValueError("Expected coefficients of shape {0}, got {1}".format(
+                (4, nslices, ncoeffs), self.coeffs.shape))
+        # row of each slice number, -1 for unknown slices
+        self._rows = np.full(self.slices.max() + 1, -1, dtype=np.intp)
+        self._rows[self.slices] = np.arange(nslices)
+        self._terms = poly2d_terms(degree)
+
+    def __getattr__(self, name):
+        if name in self.terms:
+            return self.coeffs[self.terms.index(name)]
+        raise AttributeError(name)
+
+    @classmethod
+    def from_models(cls, slice_models):
+        """
+        Stack the models of each slice.
+
+        Parameters
+        ----------
+        slice_models : dict
+            {slice number: dict returned by `ifupost_slice`}
+        """
+        slices = sorted(slice_models)
+        matrix = []
+        translation = []
+        coeffs = []
+        for n in slices:
+            model = slice_models[n]
+            matrix.append(model['linear'].matrix.value)
+            translation.append(model['linear'].translation.value)
+            coeffs.append([model[term].parameters for term in cls.terms])
+        degree = slice_models[slices[0]]['xpoly'].degree
+        return cls(slices, degree, matrix, translation, np.transpose(coeffs, (1, 0, 2)))
+
+    @classmethod
+    def from_pcf(cls, ifupost_files, cache=None, workers=8):
+        """
+        Create the stack from the IDT ``IFU-POST_N.pcf`` files.
+
+        Parameters
+        ----------
+        ifupost_files : list of str
+            Names of the ``IFU-POST`` files.
+        cache : `~jwreftools.nirspec.cache.ModelCache`, optional
+            Cache of parsed files.
+        workers : int
+            Number of threads reading the files.
+        """
+        read = functools.partial(_read_slice, cache=cache)
+        return cls.from_models(dict(parallel_map(read, ifupost_files, workers=workers)))
+
+    def __call__(self, x, y, lam, slice_id, chunk_size=65536):
+        """
+        Evaluate the forward transform of points in any slice.
+
+        The points are sorted by slice once; each slice is then a contiguous
+        block evaluated with the monomials shared by its four polynomials.
+
+        Parameters
+        ----------
+        x, y, lam : ndarray
+            Coordinates and wavelength.
+        slice_id : ndarray of int
+            Slice number of each point. Points in unknown slices are NaN.
+
+        Returns
+        -------
+        xout, yout : ndarray
+        """
+        x, y, lam, slice_id = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+                                                  np.asarray(y, dtype=np.float64),
+                                                  np.asarray(lam, dtype=np.float64),
+                                                  np.asarray(slice_id, dtype=np.intp))
+        shape = x.shape
+        x, y, lam, slice_id = x.ravel(), y.ravel(), lam.ravel(), slice_id.ravel()
+        valid = (slice_id >= 0) & (slice_id < self._rows.size)
+        rows = np.full(slice_id.shape, -1, dtype=np.intp)
+        rows[valid] = self._rows[slice_id[valid]]
+
+        order = np.argsort(rows, kind='stable')
+        bounds = np.searchsorted(rows[order], np.arange(len(self.slices) + 1))
+        out = np.full((2, x.size), np.nan)
+        for row in range(len(self.slices)):
+            for start in range(bounds[row], bounds[row + 1], chunk_size):
+                idx = order[start:min(start + chunk_size, bounds[row + 1])]
+                out[:, idx] = self._evaluate(row, x[idx], y[idx], lam[idx])
+        return out[0].reshape(shape), out[1].reshape(shape)
+
+    def _evaluate(self, row, x, y, lam):
+        (m00, m01), (m10, m11) = self.matrix[row]
+        xl = m00 * x + m01 * y + self.translation[row, 0]
+        yl = m10 * x + m11 * y + self.translation[row, 1]
+
+        # The four polynomials share the monomials xl**i * yl**j.
+        poly = np.empty((4, x.size))
+        evaluate_polynomials(self.degree, self._terms, self.coeffs[:, row], xl, yl, poly)
+        return poly[0] + poly[1] * lam, poly[2] + poly[3] * lam
+
+
+def ifupost2asdf(ifupost_files, author, description, useafter, cache=None, workers=8):
     """
     Create a reference file of type ``ifupost`` .
 
@@ -22,64 +230,21 @@ def ifupost2asdf(ifupost_files, author, description, useafter):
     ----------
     ifupost_files : list
         Names of all ``IFU-POST`` IDT reference files
-    outname : str
-        Name of output ``ASDF`` file
+    author : str
+        Author field.
+    description : str
+        Consice description of the file.
+    useafter : str
+        A useafter date in ISO format.
+    cache : `~jwreftools.nirspec.cache.ModelCache`, optional
+        Cache of parsed files and models.
+    workers : int
+        Number of threads reading and converting the files.
+        The slices are added in the order of ``ifupost_files``.
     """
     ifupost_model = IFUPostModel()
-    for fifu in ifupost_files:
-        fifu_name = os.path.split(fifu)[1]
-        n = int((fifu_name.split('IFU-POST_')[1]).split('.pcf')[0])
-
-        with open(fifu) as f:
-            lines = [l.strip() for l in f.readlines()]
-        factors = lines[lines.index('*Factor 2') + 1].split()
-        rotation_angle = float(lines[lines.index('*Rotation') + 1])
-        input_rot_center = lines[lines.index('*InputRotationCentre 2') + 1].split()
-        output_rot_center = lines[lines.index('*OutputRotationCentre 2') + 1].split()
-        linear_sky2det = homothetic_sky2det(input_rot_center, rotation_angle, factors,
-                                            output_rot_center, name='ifupost')
-
-        degree = int(lines[lines.index('*FitOrder') + 1])
-
-        xcoeff_index = lines.index('*xForwardCoefficients 21 2')
-        xlines = lines[xcoeff_index + 1: xcoeff_index + 22]
-        xcoeff_forward = coeffs_from_pcf(degree, xlines)
-        x_poly_forward = models.Polynomial2D(degree, name='ifupost_x_forw', **xcoeff_forward)
-        xlines_distortion = lines[xcoeff_index + 22: xcoeff_index + 43]
-        xcoeff_forward_distortion = coeffs_from_pcf(degree, xlines_distortion)
-        x_poly_forward_distortion = models.Polynomial2D(degree, name="ifupost_x_forwdist",
-                                                         **xcoeff_forward_distortion)
-
-        ycoeff_index = lines.index('*yForwardCoefficients 21 2')
-        ycoeff_forward = coeffs_from_pcf(degree, lines[ycoeff_index + 1: ycoeff_index + 22])
-        y_poly_forward = models.Polynomial2D(degree, name='ifupost_y_forw', **ycoeff_forward)
-        ylines_distortion = lines[ycoeff_index + 22: ycoeff_index + 43]
-        ycoeff_forward_distortion = coeffs_from_pcf(degree, ylines_distortion)
-        y_poly_forward_distortion = models.Polynomial2D(degree, name="ifupost_y_forwdist",
-                                                     **ycoeff_forward_distortion)
-
-        xcoeff_index = lines.index('*xBackwardCoefficients 21 2')
-        xcoeff_backward = coeffs_from_pcf(degree, lines[xcoeff_index + 1: xcoeff_index + 22])
-        x_poly_backward = models.Polynomial2D(degree, name='ifupost_x_back', **xcoeff_backward)
-
-        ycoeff_index = lines.index('*yBackwardCoefficients 21 2')
-        ycoeff_backward = coeffs_from_pcf(degree, lines[ycoeff_index + 1: ycoeff_index + 22])
-        y_poly_backward = models.Polynomial2D(degree, name='ifupost_y_back', **ycoeff_backward)
-
-        x_poly_forward.inverse = x_poly_backward
-        y_poly_forward.inverse = y_poly_backward
-
-        output2poly_mapping = Identity(2, name='ifupost_outmap')
-        output2poly_mapping.inverse = Mapping([0, 1, 2, 0, 1, 2])
-        input2poly_mapping = Mapping([0, 1, 2, 0, 1, 2], name='ifupost_inmap')
-        input2poly_mapping.inverse = Identity(2)
-
-        model = {'linear': linear_sky2det,
-                 'xpoly': x_poly_forward,
-                 'xpoly_distortion': x_poly_forward_distortion,
-                 'ypoly': y_poly_forward,
-                 'ypoly_distortion': y_poly_forward_distortion
-                 }
+    read = functools.partial(_read_slice, cache=cache)
+    for n, model in parallel_map(read, ifupost_files, workers=workers):
         name = "slice_{0}".format(n)
         setattr(ifupost_model, name, model)
 
@@ -90,7 +255,8 @@ def ifupost2asdf(ifupost_files, author, description, useafter):
     return ifupost_model
 
 
-def create_ifupost_reference(model_dir, out_name, author=None, description=None, useafter=None):
+def create_ifupost_reference(model_dir, out_name, author=None, description=None, useafter=None,
+                             cache=None, workers=8, write_options=None):
     """
     Create the IFUPOST reference.
 
@@ -107,23 +273,19 @@ def create_ifupost_reference(model_dir, out_name, author=None, description=None,
         Consice description of the file.
     useafter : str
         A useafter date in ISO format.
+    cache : `~jwreftools.nirspec.cache.ModelCache`, optional
+        Cache of parsed files and models.
+    workers : int
+        Number of threads reading and converting the ``IFU-POST`` files.
+    write_options : dict, optional
+        Arguments of `~jwreftools.nirspec.writer.write_reference`.
     """
     model_dir = os.path.join(model_dir, "CoordTransform", "IFU")
-    ifupost_list = glob.glob(model_dir + '/IFU-POST*')
-    f = open(ifupost_list[0])
-    lines = f.readlines()
-    f.close()
-    lines = [l.strip() for l in lines]
-    for i, line in enumerate(lines):
-        if 'AUTHOR' in line:
-            auth = lines[i + 1]
-            continue
-        elif 'DESCRIPTION' in line:
-            descrip = lines[i + 1]
-            continue
-        elif 'DATE' in line:
-            date = lines[i + 1]
-            continue
+    ifupost_list = sorted(glob.glob(model_dir + '/IFU-POST*'), key=_slice_number)
+    header = PcfDocument.read(ifupost_list[0], cache=cache).header
+    auth = header['author']
+    descrip = header['description']
+    date = header['date']
 
     if author is None:
         author = auth
@@ -133,7 +295,8 @@ def create_ifupost_reference(model_dir, out_name, author=None, description=None,
         useafter = date
 
     try:
-        model = ifupost2asdf(ifupost_list, author, description, useafter)
+        model = ifupost2asdf(ifupost_list, author, description, useafter, cache=cache,
+                             workers=workers)
     except:
         raise Exception("IFUPOST file was not created.")
     entry = HistoryEntry({'description': "New version created from CV3 with updated file structure", 'time': datetime.datetime.utcnow()})
@@ -141,5 +304,5 @@ def create_ifupost_reference(model_dir, out_name, author=None, description=None,
                          'homepage': 'https://github.com/spacetelescope/jwreftools', 'version': "0.7.1"})
     entry['software'] = software
     model.history.append(entry)
-    model.to_asdf(out_name)
+    write_reference(model, out_name, reftype='ifupost', **(write_options or {}))
     model.validate()
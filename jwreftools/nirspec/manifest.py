@@ -0,0 +1,92 @@
+"""
+Manifest of a NIRSPEC reference file delivery.
+
+The manifest is a JSON file kept next to the reference files. For each
+reference file it records the input files and their hashes, the version of
+the converters and the keywords (author, description, useafter) passed to
+them. A reference file is rebuilt only if one of these changed.
+"""
+import json
+import os.path
+
+from .cache import converter_version, file_hash
+
+
+__all__ = ['Manifest']
+
+
+MANIFEST_NAME = "nirspec_manifest.json"
+
+
+class Manifest(object):
+    """
+    Record of the inputs of each reference file.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the JSON manifest file. It's read if it exists.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self._hashes = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.entries = json.load(f)
+
+    def _key(self, output):
+        # Outputs are recorded relative to the manifest.
+        return os.path.relpath(output, os.path.dirname(self.filename) or ".")
+
+    def input_hashes(self, inputs):
+        """ Return a dictionary {path: hash}; each file is hashed once."""
+        hashes = {}
+        for path in inputs:
+            if path not in self._hashes:
+                self._hashes[path] = file_hash(path) if os.path.exists(path) else None
+            hashes[path] = self._hashes[path]
+        return hashes
+
+    def outdated(self, output, inputs, keywords):
+        """
+        Return the reason ``output`` must be rebuilt, or None if it's up to date.
+
+        Parameters
+        ----------
+        output : str
+            Name of the reference file.
+        inputs : list of str
+            Names of the input files.
+        keywords : dict
+            Keywords passed to the converter.
+        """
+        entry = self.entries.get(self._key(output))
+        if entry is None:
+            return "not in manifest"
+        if not os.path.exists(output):
+            return "output missing"
+        if entry['version'] != converter_version():
+            return "converter version changed"
+        if entry['keywords'] != keywords:
+            return "keywords changed"
+        hashes = self.input_hashes(inputs)
+        if set(hashes) != set(entry['inputs']):
+            return "input files changed"
+        for path in sorted(hashes):
+            if hashes[path] is None or hashes[path] != entry['inputs'][path]:
+                return "{0} changed".format(os.path.basename(path))
+        return None
+
+    def record(self, output, inputs, keywords):
+        """ Record a successfully built reference file."""
+        self.entries[self._key(output)] = {'inputs': self.input_hashes(inputs),
+                                           'version': converter_version(),
+                                           'keywords': keywords}
+
+    def remove(self, output):
+        self.entries.pop(self._key(output), None)
+
+    def write(self):
+        with open(self.filename, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
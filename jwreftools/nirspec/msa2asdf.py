@@ -2,11 +2,377 @@ import datetime
 import os.path
 import numpy as np
 from asdf.tags.core import Software, HistoryEntry
-from astropy.io import fits
-from astropy.modeling import models
 from jwst.datamodels import MSAModel
+from .utils import rotation_shift, fits_input
+from .writer import write_reference
+
+__all__ = ["create_msa_reference", "msa2asdf", "MSAShutterIndex", "msa_shutter_centres"]
+
+
+# Number of shutter rows in an MSA quadrant.
+NROWS = 365
+
+
+def _quadrant_models(f):
+    """
+    Return the table and the transform to the MSA frame of quadrants 1 to 5.
+
+    Quadrant 5 holds the fixed slits and the IFU aperture.
+
+    Parameters
+    ----------
+    f : `~astropy.io.fits.HDUList`
+        An open MSA description file (MSA.msa).
+
+    Returns
+    -------
+    quadrants : list of (data, model)
+        The table of each quadrant and its
+        `~astropy.modeling.models.AffineTransformation2D`.
+    """
+    quadrants = []
+    for i in range(1, 6):
+        header = f[i].header
+        # Rotation2D | Shift & Shift folded in one affine transform
+        if i < 5:
+            model = rotation_shift(np.rad2deg(header['QUADROT']), header['QUADXREF'],
+                                   header['QUADYREF'], name='msa_Q{0}'.format(i))
+        else:
+            model = rotation_shift(np.rad2deg(header['SLITROT']), header['SLITXREF'],
+                                   header['SLITYREF'], name='msa_slit')
+        quadrants.append((f[i].data, model))
+    return quadrants
+
+
+class MSAShutterIndex(object):
+    """
+    Array backed index of the shutters of all MSA quadrants.
+
+    The shutters of quadrants 1 to 5 are stored in flat arrays, quadrant by
+    quadrant, in the order of the table rows. Shutters are identified by the
+    ``num`` column of the tables, ``num = row + (column - 1) * 365``
+    (``column`` is 1 for quadrant 5).
+
+    For the reverse lookup the shutter centres of each quadrant are hashed
+    into a grid of about one cell per shutter. Each cell holds the list of
+    shutters with their centre in it, so the grid size does not depend on
+    how close the centres are. A point belongs to a shutter if it lies in
+    the shutter rectangle, so only the cells around the cell of the point
+    are searched.
+
+    The index is not stored in the reference file; create it from the
+    ``MSA.msa`` file or the MSA reference model.
+
+    Parameters
+    ----------
+    offsets : ndarray of shape (6,)
+        Start of each quadrant in the flat arrays.
+    num : ndarray of int, shape (n_shutters,)
+        Shutter numbers, the ``num`` column of the tables.
+    centre, size : ndarray of shape (n_shutters, 2)
+        Centre and size of the shutters in the quadrant frame.
+    matrix, translation : ndarray of shape (5, 2, 2) and (5, 2)
+        Affine transforms from the quadrant frames to the MSA frame.
+    """
+    def __init__(self, offsets, num, centre, size, matrix, translation):
+        self.offsets = np.asarray(offsets, dtype=np.intp)
+        self.num = np.asarray(num, dtype=np.intp)
+        self.centre = np.asarray(centre, dtype=np.float64)
+        self.size = np.asarray(size, dtype=np.float64)
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self.translation = np.asarray(translation, dtype=np.float64)
+        # Shutter numbers of each quadrant, sorted, and their flat index.
+        self._sorted = []
+        # Hash grid of each quadrant: origin, cell size, shape, and the
+        # flat indices of the shutters of cell k in members[starts[k]: starts[k + 1]].
+        self._grids = []
+        for start, stop in zip(self.offsets[:-1], self.offsets[1:]):
+            order = np.argsort(self.num[start: stop], kind='stable')
+            self._sorted.append((self.num[start: stop][order], order + start))
+            self._grids.append(self._hash_grid(self.centre[start: stop], self.size[start: stop],
+                                               start))
+
+    @classmethod
+    def from_quadrants(cls, quadrants):
+        """
+        Build the index.
+
+        Parameters
+        ----------
+        quadrants : list of (data, model)
+            For quadrants 1 to 5, the MSA table with columns
+            (num, xcenter, ycenter, xsize, ysize) and the
+            `~astropy.modeling.models.AffineTransformation2D` to the MSA frame.
+        """
+        offsets = [0]
+        num = []
+        centre = []
+        size = []
+        matrix = []
+        translation = []
+        for data, model in quadrants:
+            num.append(np.asarray(data.field(0), dtype=np.intp))
+            centre.append(np.column_stack([data.field(1), data.field(2)]).astype(np.float64))
+            size.append(np.column_stack([data.field(3), data.field(4)]).astype(np.float64))
+            offsets.append(offsets[-1] + len(data))
+            matrix.append(model.matrix.value)
+            translation.append(model.translation.value)
+        return cls(offsets, np.concatenate(num), np.concatenate(centre), np.concatenate(size),
+                   matrix, translation)
+
+    @classmethod
+    def from_file(cls, msafile):
+        """
+        Build the index from an ``MSA.msa`` file.
+
+        Parameters
+        ----------
+        msafile : str or `~astropy.io.fits.HDUList`
+            A fits file with MSA description (MSA.msa).
+        """
+        with fits_input(msafile) as f:
+            return cls.from_quadrants(_quadrant_models(f))
+
+    @classmethod
+    def from_model(cls, msa_model):
+        """
+        Build the index from an MSA reference model.
+
+        Parameters
+        ----------
+        msa_model : `~jwst.datamodels.MSAModel`
+            The model returned by `msa2asdf` or read from an MSA reference file.
+        """
+        quadrants = []
+        for i in range(1, 6):
+            quadrant = getattr(msa_model, "Q{0}".format(i))
+            if isinstance(quadrant, dict):
+                quadrants.append((quadrant['data'], quadrant['model']))
+            else:
+                quadrants.append((quadrant.data, quadrant.model))
+        return cls.from_quadrants(quadrants)
+
+    @staticmethod
+    def _hash_grid(centre, size, offset):
+        """
+        Hash the centres of a quadrant into a grid of about one cell per shutter.
+
+        The grid has at most 3 * n + 1 cells for n shutters, whatever the
+        positions of the centres.
+        """
+        valid = np.isfinite(centre).all(axis=1)
+        points = centre[valid]
+        index = np.flatnonzero(valid) + offset
+        if len(points) == 0:
+            return (np.zeros(2), 1., (1, 1), np.zeros(2, dtype=np.intp),
+                    np.zeros(0, dtype=np.intp), np.zeros(2, dtype=np.intp))
+        origin = points.min(axis=0)
+        extent = points.max(axis=0) - origin
+        cell = max(np.sqrt(extent[0] * extent[1] / len(points)), extent.max() / len(points))
+        if cell == 0:
+            cell = 1.
+        ij = np.floor((points - origin) / cell).astype(np.intp)
+        shape = tuple(ij.max(axis=0) + 1)
+        flat = np.ravel_multi_index(ij.T, shape)
+        order = np.argsort(flat, kind='stable')
+        starts = np.zeros(shape[0] * shape[1] + 1, dtype=np.intp)
+        np.cumsum(np.bincount(flat, minlength=shape[0] * shape[1]), out=starts[1:])
+        # Number of cells around a point which can hold the centre of its shutter.
+        halfsize = np.nanmax(size[valid], axis=0) / 2.
+        radius = np.ceil(np.nan_to_num(halfsize) / cell).astype(np.intp)
+        return origin, cell, shape, starts, index[order], radius
+
+    def flat_index(self, quadrant, row, column=1):
+        """
+        Return the position of shutters in the flat arrays, -1 if they don't exist.
+
+        Parameters
+        ----------
+        quadrant, row, column : int or ndarray of int
+            1-based quadrant, row and column of the shutters.
+        """
+        quadrant, row, column = np.broadcast_arrays(np.asarray(quadrant, dtype=np.intp),
+                                                    np.asarray(row, dtype=np.intp),
+                                                    np.asarray(column, dtype=np.intp))
+        index = np.full(quadrant.shape, -1, dtype=np.intp)
+        # Rows above NROWS exist only in the single column of quadrant 5,
+        # the fixed slits and IFU aperture; in quadrants 1 to 4 they would
+        # wrap into the next column.
+        valid = (quadrant >= 1) & (quadrant <= len(self._sorted)) & (row >= 1) & \
+            (column >= 1) & ((row <= NROWS) | ((quadrant == 5) & (column == 1)))
+        num = row + (column - 1) * NROWS
+        for q, (snum, position) in enumerate(self._sorted):
+            selected = valid & (quadrant == q + 1)
+            if not selected.any() or len(snum) == 0:
+                continue
+            k = np.searchsorted(snum, num[selected])
+            k[k == len(snum)] = 0
+            found = snum[k] == num[selected]
+            index[selected] = np.where(found, position[k], -1)
+        return index
+
+    def lookup(self, quadrant, row, column=1):
+        """
+        Return the centre and size of shutters in the quadrant frame.
+
+        Parameters
+        ----------
+        quadrant, row, column : int or ndarray of int
+            1-based quadrant, row and column of the shutters.
+
+        Returns
+        -------
+        centre, size : ndarray of shape (..., 2)
+            NaN for shutters which don't exist.
+        """
+        index = self.flat_index(quadrant, row, column)
+        centre = np.full(index.shape + (2,), np.nan)
+        size = np.full(index.shape + (2,), np.nan)
+        found = index >= 0
+        centre[found] = self.centre[index[found]]
+        size[found] = self.size[index[found]]
+        return centre, size
+
+    def msa_centres(self, quadrants=(1, 2, 3, 4), dtype=np.float64):
+        """
+        Return the centres of all shutters in the MSA frame.
+
+        Parameters
+        ----------
+        quadrants : list of int
+            Quadrants to include, in this order.
+        dtype : numpy dtype
+            Type of the output arrays, e.g. ``np.float32``.
+
+        Returns
+        -------
+        x, y : ndarray
+            Contiguous arrays of the centres, quadrant after quadrant in
+            the order of the table rows.
+        quadrant : ndarray of int8
+            Quadrant of each shutter.
+        """
+        return _msa_centres(self.centre, self.offsets, self.matrix, self.translation,
+                            quadrants, dtype)
+
+    def locate(self, x, y):
+        """
+        Find the shutters containing points in the MSA frame.
+
+        Parameters
+        ----------
+        x, y : ndarray
+            Coordinates in the MSA frame.
+
+        Returns
+        -------
+        quadrant, row, column : ndarray of int
+            1-based quadrant, row and column, 0 for points outside all shutters.
+        """
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+                                   np.asarray(y, dtype=np.float64))
+        shape = x.shape
+        points = np.column_stack([x.ravel(), y.ravel()])
+        found = np.full(len(points), -1, dtype=np.intp)
+        quadrant = np.zeros(len(points), dtype=np.intp)
+        for q in range(len(self._grids)):
+            todo = np.flatnonzero(found < 0)
+            if len(todo) == 0:
+                break
+            # MSA frame to quadrant frame
+            local = np.linalg.solve(self.matrix[q], (points[todo] - self.translation[q]).T).T
+            index = self._search(q, local)
+            hit = index >= 0
+            found[todo[hit]] = index[hit]
+            quadrant[todo[hit]] = q + 1
+        row = np.zeros(len(points), dtype=np.intp)
+        column = np.zeros(len(points), dtype=np.intp)
+        hit = found >= 0
+        num = self.num[found[hit]]
+        row[hit] = (num - 1) % NROWS + 1
+        column[hit] = (num - 1) // NROWS + 1
+        return quadrant.reshape(shape), row.reshape(shape), column.reshape(shape)
+
+    def _search(self, q, local):
+        """ Return the flat index of the shutter of quadrant q containing each point."""
+        origin, cell, shape, starts, members, (iradius, jradius) = self._grids[q]
+        ij = np.floor((local - origin) / cell).astype(np.intp)
+        index = np.full(len(local), -1, dtype=np.intp)
+        for di in range(-iradius, iradius + 1):
+            for dj in range(-jradius, jradius + 1):
+                i = ij[:, 0] + di
+                j = ij[:, 1] + dj
+                points = np.flatnonzero((index < 0) & (i >= 0) & (i < shape[0]) &
+                                        (j >= 0) & (j < shape[1]))
+                k = i[points] * shape[1] + j[points]
+                first = starts[k]
+                count = starts[k + 1] - first
+                # the n-th shutter of the cell of each point
+                for n in range(count.max() if len(count) else 0):
+                    has = np.flatnonzero(count > n)
+                    candidate = members[first[has] + n]
+                    check = points[has]
+                    contains = np.all(np.abs(local[check] - self.centre[candidate]) <=
+                                      self.size[candidate] / 2., axis=1)
+                    new = contains & (index[check] < 0)
+                    index[check[new]] = candidate[new]
+        return index
+
+
+def _msa_centres(centre, offsets, matrix, translation, quadrants, dtype):
+    """ Transform the shutter centres of several quadrants to the MSA frame."""
+    counts = [offsets[q] - offsets[q - 1] for q in quadrants]
+    x = np.empty(sum(counts), dtype=dtype)
+    y = np.empty(sum(counts), dtype=dtype)
+    quadrant = np.repeat(np.array(quadrants, dtype=np.int8), counts)
+    start = 0
+    for q, count in zip(quadrants, counts):
+        local = centre[offsets[q - 1]: offsets[q]]
+        (m00, m01), (m10, m11) = matrix[q - 1]
+        x[start: start + count] = m00 * local[:, 0] + m01 * local[:, 1] + translation[q - 1, 0]
+        y[start: start + count] = m10 * local[:, 0] + m11 * local[:, 1] + translation[q - 1, 1]
+        start += count
+    return x, y, quadrant
+
+
+def msa_shutter_centres(msafile, quadrants=(1, 2, 3, 4), dtype=np.float64):
+    """
+    Return the centres of all shutters of an ``MSA.msa`` file in the MSA frame.
+
+    This is equivalent to evaluating the model of each quadrant on the
+    (xcenter, ycenter) columns of its table, done in one pass per quadrant.
+
+    Parameters
+    ----------
+    msafile : str or `MSAShutterIndex`
+        A fits file with MSA description (MSA.msa) or a shutter index.
+    quadrants : list of int
+        Quadrants to include, 5 for the fixed slits and IFU aperture.
+    dtype : numpy dtype
+        Type of the output arrays, e.g. ``np.float32``.
+
+    Returns
+    -------
+    x, y : ndarray
+        Centres of the shutters, quadrant after quadrant.
+    quadrant : ndarray of int8
+        Quadrant of each shutter.
+    """
+    if isinstance(msafile, MSAShutterIndex):
+        return msafile.msa_centres(quadrants, dtype)
+    with fits_input(msafile) as f:
+        offsets = [0]
+        centre = []
+        matrix = []
+        translation = []
+        for data, model in _quadrant_models(f):
+            centre.append(np.column_stack([data.field(1), data.field(2)]).astype(np.float64))
+            offsets.append(offsets[-1] + len(data))
+            matrix.append(model.matrix.value)
+            translation.append(model.translation.value)
+    return _msa_centres(np.concatenate(centre), offsets, np.array(matrix),
+                        np.array(translation), quadrants, dtype)
 
-__all__ = ["create_msa_reference", "msa2asdf"]
 
 def msa2asdf(msafile, author, description, useafter):
     """
@@ -16,30 +382,23 @@ def msa2asdf(msafile, author, description, useafter):
 
     Parameters
     ----------
-    msafile : str
-        A fits file with MSA description (MSA.msa)
+    msafile : str or `~astropy.io.fits.HDUList`
+        A fits file with MSA description (MSA.msa). The tables are memory
+        mapped views of the file; pass an open file to keep it open until
+        the reference file is written.
     outname : str
         Name of output ASDF file.
     """
-    f = fits.open(msafile)
-    data = f[5].data # SLITS and IFU
-    header = f[5].header
-    shiftx = models.Shift(header['SLITXREF'], name='msa_slit_x')
-    shifty = models.Shift(header['SLITYREF'], name='msa_slit_y')
-    slitrot = models.Rotation2D(np.rad2deg(header['SLITROT']), name='msa_slit_rot')
-    msa_model = MSAModel()
-    msa_model.Q5.model = slitrot | shiftx & shifty
-    msa_model.Q5.data = f[5].data
-    for i in range(1, 5):
-        header = f[i].header
-        shiftx = models.Shift(header['QUADXREF'], name='msa_Q{0}_x'.format(i))
-        shifty = models.Shift(header['QUADYREF'], name='msa_Q{0}_y'.format(i))
-        slitrot = models.Rotation2D(np.rad2deg(header['QUADROT']), name='msa_Q{0}_rot'.format(i))
-        model = slitrot | shiftx & shifty
-        data = f[i].data
-        name = "Q{0}".format(i)
-        setattr(msa_model, name, {'model': model, 'data': data})
-    f.close()
+    with fits_input(msafile) as f:
+        quadrants = _quadrant_models(f)
+        msa_model = MSAModel()
+        # SLITS and IFU
+        slit_data, slit_model = quadrants[4]
+        msa_model.Q5.model = slit_model
+        msa_model.Q5.data = slit_data
+        for i, (data, model) in enumerate(quadrants[:4], 1):
+            name = "Q{0}".format(i)
+            setattr(msa_model, name, {'model': model, 'data': data})
     msa_model.meta.author = author
     msa_model.meta.description = description
     msa_model.meta.useafter = useafter
@@ -58,27 +417,29 @@ def msa2asdf(msafile, author, description, useafter):
 #    else:
 #        output_name = res.output_name
 #    ref_kw = common_reference_file_keywords("MSA", "NIRSPEC MSA Description - CDP4")
-def create_msa_reference(msa_file, output_name, author=None, description=None, useafter=None):
-    f = fits.open(msa_file)
-    auth = f[0].header['AUTHOR']
-    descrip = f[0].header['DESCR']
-    date = f[0].header['DATE']
-    f.close()
-    if author is None:
-        author = auth
-    if description is None:
-        description = descrip
-    if useafter is None:
-        useafter = date
-    try:
-        msa_model = msa2asdf(msa_file, author, description, useafter)
-    except:
-        raise Exception("MSA file was not converted")
-    entry = HistoryEntry({'description': "New version created from CV3 with updated file structure", 'time': datetime.datetime.utcnow()})
-    software = Software({'name': 'jwstreftools', 'author': 'N.Dencheva',
-                         'homepage': 'https://github.com/spacetelescope/jwreftools', 'version': "0.7.1"})
-    entry['software'] = software
-    msa_model.history.append(entry)
-    msa_model.to_asdf(output_name)
-    msa_model.validate()
+def create_msa_reference(msa_file, output_name, author=None, description=None, useafter=None,
+                         write_options=None):
+    # The file is opened once, memory mapped, and kept open until the
+    # tables are written to the reference file.
+    with fits_input(msa_file) as f:
+        auth = f[0].header['AUTHOR']
+        descrip = f[0].header['DESCR']
+        date = f[0].header['DATE']
+        if author is None:
+            author = auth
+        if description is None:
+            description = descrip
+        if useafter is None:
+            useafter = date
+        try:
+            msa_model = msa2asdf(f, author, description, useafter)
+        except:
+            raise Exception("MSA file was not converted")
+        entry = HistoryEntry({'description': "New version created from CV3 with updated file structure", 'time': datetime.datetime.utcnow()})
+        software = Software({'name': 'jwstreftools', 'author': 'N.Dencheva',
+                             'homepage': 'https://github.com/spacetelescope/jwreftools', 'version': "0.7.1"})
+        entry['software'] = software
+        msa_model.history.append(entry)
+        write_reference(msa_model, output_name, reftype='msa', **(write_options or {}))
+        msa_model.validate()
 
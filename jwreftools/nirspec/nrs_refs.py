@@ -1,42 +1,84 @@
-import os.path
+"""
+Command line driver creating the NIRSPEC reference files.
+
+Examples
+--------
+Create all reference files with 4 processes::
+
+    $ nrs_refs all /path/to/cv3_model /path/to/output --jobs 4
+
+Show which FORE and MSA files are out of date::
+
+    $ nrs_refs fore msa /path/to/cv3_model /path/to/output --dry-run
+
+"""
 import argparse
-#from asdf import AsdfFile
-#from astropy.modeling.models import Mapping, Identity
-#from astropy.modeling import models
-#from .utils import (linear_from_pcf_det2sky, common_reference_file_keywords,
-#                    coeffs_from_pcf)
-
-reftypes = ['camera', 'collimator', 'fpa', 'disperser', 'fore', 'ifuslicer', 'ifupost', 'msa', 'ote', 'wavelenghtrange']
-
-
-def create_all(model_path):
-    pass
-    
-reftype_mapping = {'camera': camera2asdf, 
-                   'collimator': collimator2asdf, 
-                   'fpa': fpa2asdf,
-                   'disperser': dispoerser2asdf,
-                   'fore': fore2asdf, 
-                   'ifuslicer': ifuslicer2asdf,
-                   'ifupost': ifupost2asdf,
-                   'msa': msa2asdf,
-                   'ote': ote2asdf,
-                   'wavelenghtrange': wave_range2asdf}
-
-  
-if __name__ == '__main__':
+import sys
+
+from .generate_references import generate, reference_types
+from .writer import STORAGE, COMPRESSION, FLOAT32_REFTYPES
+
+
+__all__ = ['main']
+
+
+reftypes = reference_types()
+
+
+def main(args=None):
     parser = argparse.ArgumentParser(description="Creates NIRSpec reference files in ASDF format.")
-    parser.add_argument("mode", type=str, help="'all' or one of reftypes")
-    parser.add_argument("model_path", type=str, help="Directory path to NIRSpec Model.")
-    parser.add_argument("reffile_path", type=str, help="File path to NIRSpec Reference file.")
-    parser.add_argument("output_name", type=str, help="Output file name.")
-    res = parser.parse_args()
-    if res.mode == "all":
-        create_all(res.model_path)
+    parser.add_argument("mode", type=str, nargs='+',
+                        help="'all' or one or more of {0}".format(", ".join(reftypes)))
+    parser.add_argument("model_dir", type=str, help="Directory path to NIRSpec Model.")
+    parser.add_argument("output_dir", type=str, help="Directory for the reference files.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of reference files created in parallel.")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="Only print the reference files which would be created.")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Create the reference files even if they are up to date.")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="Directory with a cache of parsed IDT files.")
+    parser.add_argument("--author", type=str, default=None, help="Author field.")
+    parser.add_argument("--description", type=str, default=None, help="Description field.")
+    parser.add_argument("--useafter", type=str, default=None, help="Useafter date.")
+    parser.add_argument("--storage", type=str, default=None, choices=STORAGE,
+                        help="ASDF array storage.")
+    parser.add_argument("--compression", type=str, default=None,
+                        choices=[c for c in COMPRESSION if c is not None],
+                        help="ASDF block compression.")
+    parser.add_argument("--float32", action="store_true",
+                        help="Write large float64 arrays of the {0} files as float32.".format(
+                            ", ".join(r for r in FLOAT32_REFTYPES if r in reftypes)))
+    res = parser.parse_args(args)
+
+    if "all" in res.mode:
+        selected = None
     else:
-        if res.reffile_path is None:
-            raise ValueError("expect a path to a reference file.")
-        reftype_mapping[res.mode](res.reffile_path, res.output_name)
+        unknown = [mode for mode in res.mode if mode not in reftypes]
+        if unknown:
+            parser.error("unknown reference type(s): {0}".format(", ".join(unknown)))
+        selected = res.mode
 
-        
-   
+    write_options = None
+    if res.storage or res.compression or res.float32:
+        write_options = {}
+        for reftype in selected or reftypes:
+            # Only the reference types with large tables are downcast.
+            float32 = res.float32 and reftype in FLOAT32_REFTYPES
+            write_options[reftype] = {'storage': res.storage, 'compression': res.compression,
+                                      'float32': float32 or None}
+
+    try:
+        generate(res.model_dir, cache=res.cache, jobs=res.jobs, force=res.force,
+                 author=res.author, description=res.description, useafter=res.useafter,
+                 output_dir=res.output_dir, reftypes=selected, dry_run=res.dry_run,
+                 write_options=write_options)
+    except RuntimeError as e:
+        print(e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
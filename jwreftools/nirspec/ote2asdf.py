@@ -3,7 +3,8 @@ from jwst.datamodels import OTEModel
 from asdf.tags.core import Software, HistoryEntry
 from astropy.modeling import models
 from astropy.modeling.models import Mapping, Identity
-from .utils import homothetic_det2sky, coeffs_from_pcf
+from .utils import homothetic_det2sky, polynomial2d, PcfDocument
+from .writer import write_reference
 
 __all__ = ["create_ote_reference", "ote2asdf"]
 
@@ -11,39 +12,25 @@ __all__ = ["create_ote_reference", "ote2asdf"]
 def ote2asdf(otepcf, author, description, useafter):
     """
     """
-    with open(otepcf) as f:
-        lines = [l.strip() for l in f.readlines()]
+    pcf = PcfDocument.read(otepcf)
 
-    factors = lines[lines.index('*Factor 2 1') + 1].split()
     # this corresponds to modeling Rotation direction as is
-    rotation_angle = float(lines[lines.index('*Rotation') + 1])
-    input_rot_center = lines[lines.index('*InputRotationCentre 2 1') + 1].split()
-    output_rot_center = lines[lines.index('*OutputRotationCentre 2 1') + 1].split()
+    mlinear = homothetic_det2sky(pcf.input_rotation_centre, pcf.rotation,
+                                 pcf.factors, pcf.output_rotation_centre, name="ote")
 
-    mlinear = homothetic_det2sky(input_rot_center, rotation_angle,
-                                 factors, output_rot_center, name="ote")
+    degree = pcf.fit_order
 
-    degree = int(lines[lines.index('*FitOrder') + 1])
+    xcoeff_backward, = pcf.polynomial_coefficients('xBackwardCoefficients')
+    x_poly_forward = polynomial2d(degree, xcoeff_backward, name='ote_x_forw')
 
-    xcoeff_index = lines.index('*xBackwardCoefficients 21 2')
-    xlines = lines[xcoeff_index + 1].split('\t')
-    xcoeff_backward = coeffs_from_pcf(degree, xlines)
-    x_poly_forward = models.Polynomial2D(degree, name='ote_x_forw', **xcoeff_backward)
+    xcoeff_forward, = pcf.polynomial_coefficients('xForwardCoefficients')
+    x_poly_backward = polynomial2d(degree, xcoeff_forward, name='ote_x_back')
 
-    xcoeff_index = lines.index('*xForwardCoefficients 21 2')
-    xlines = lines[xcoeff_index + 1].split('\t')
-    xcoeff_forward = coeffs_from_pcf(degree, xlines)
-    x_poly_backward = models.Polynomial2D(degree, name='ote_x_back', **xcoeff_forward)
+    ycoeff_backward, = pcf.polynomial_coefficients('yBackwardCoefficients')
+    y_poly_forward = polynomial2d(degree, ycoeff_backward, name='ote_y_forw')
 
-    ycoeff_index = lines.index('*yBackwardCoefficients 21 2')
-    ylines = lines[ycoeff_index + 1].split('\t')
-    ycoeff_backward = coeffs_from_pcf(degree, ylines)
-    y_poly_forward = models.Polynomial2D(degree, name='ote_y_forw', **ycoeff_backward)
-
-    ycoeff_index = lines.index('*yForwardCoefficients 21 2')
-    ylines = lines[ycoeff_index + 1].split('\t')
-    ycoeff_forward = coeffs_from_pcf(degree, ylines)
-    y_poly_backward = models.Polynomial2D(degree, name='ote_y_backw', **ycoeff_forward)
+    ycoeff_forward, = pcf.polynomial_coefficients('yForwardCoefficients')
+    y_poly_backward = polynomial2d(degree, ycoeff_forward, name='ote_y_backw')
 
     x_poly_forward.inverse = x_poly_backward
     y_poly_forward.inverse = y_poly_backward
@@ -72,20 +59,11 @@ def ote2asdf(otepcf, author, description, useafter):
 
 
 def create_ote_reference(ote_file, output_name, author=None, description=None,
-                         useafter="2016-03-01T09:08:05"):
-    f = open(ote_file)
-    lines = [l.strip() for l in f.readlines()]
-    f.close()
-    for i, line in enumerate(lines):
-        if 'AUTHOR' in line:
-            auth = lines[i + 1]
-            continue
-        elif 'DESCRIPTION' in line:
-            descrip = lines[i + 1]
-            continue
-        elif 'DATE' in line:
-            date = lines[i + 1]
-            continue
+                         useafter="2016-03-01T09:08:05", write_options=None):
+    pcf = PcfDocument.read(ote_file)
+    auth = pcf.header['author']
+    descrip = pcf.header['description']
+    date = pcf.header['date']
 
     if author is None:
         author = auth
@@ -94,7 +72,7 @@ def create_ote_reference(ote_file, output_name, author=None, description=None,
     if useafter is None:
         useafter = date
     try:
-        model = ote2asdf(ote_file, author, description, useafter)
+        model = ote2asdf(pcf, author, description, useafter)
     except:
         raise Exception("OTE file was not converted.")
     entry = HistoryEntry({'description': "New version created from CV3 with updated file structure", 'time': datetime.datetime.utcnow()})
@@ -102,5 +80,5 @@ def create_ote_reference(ote_file, output_name, author=None, description=None,
                          'homepage': 'https://github.com/spacetelescope/jwreftools', 'version': "0.7.1"})
     entry['software'] = software
     model.history.append(entry)
-    model.to_asdf(output_name)
+    write_reference(model, output_name, reftype='ote', **(write_options or {}))
     model.validate()
@@ -0,0 +1,146 @@
+"""
+Fast evaluation of the polynomial pairs in the NIRSPEC PCF models.
+
+All models created from the IDT ``.pcf`` files have the form
+``Mapping([0, 1, 0, 1]) | (x_poly & y_poly) | Identity(2)``, i.e. two
+polynomials of the same degree evaluated on the same inputs.
+`PolynomialPair2D` evaluates both of them with one set of monomials;
+`evaluate_polynomials` does the same for any number of polynomials.
+
+Examples
+--------
+>>> model = pcf2model("Camera.pcf", name="camera")
+>>> pair = PolynomialPair2D.from_models(model['camera_x_forward'],
+...                                     model['camera_y_forward'])
+>>> xout, yout = pair(x, y)
+
+"""
+import numpy as np
+from astropy.modeling import models
+
+from .utils import PcfDocument, poly2d_terms
+
+
+__all__ = ['PolynomialPair2D', 'evaluate_polynomials']
+
+
+def evaluate_polynomials(degree, terms, coeffs, x, y, out):
+    """
+    Evaluate 2D polynomials of the same degree with one set of monomials.
+
+    The monomials ``x**i * y**j`` are computed incrementally, once for all
+    polynomials.
+
+    Parameters
+    ----------
+    degree : int
+        Degree of the polynomials.
+    terms : ndarray of int
+        The table returned by `~jwreftools.nirspec.utils.poly2d_terms`.
+    coeffs : ndarray of shape (n_polynomials, n_coeffs)
+        Coefficients in the order of the `~astropy.modeling.models.Polynomial2D`
+        parameters.
+    x, y : ndarray of shape (n,)
+        Inputs.
+    out : ndarray of shape (n_polynomials, n)
+        The values of the polynomials.
+    """
+    out[...] = 0.
+    tmp = np.empty(x.shape)
+    term = np.empty(x.shape)
+    ypow = np.ones(x.shape)
+    for j in range(degree + 1):
+        term[...] = ypow
+        for i in range(degree + 1 - j):
+            k = terms[i, j]
+            for p in range(len(coeffs)):
+                np.multiply(term, coeffs[p, k], out=tmp)
+                out[p] += tmp
+            if i < degree - j:
+                term *= x
+        if j < degree:
+            ypow *= y
+
+
+class PolynomialPair2D(object):
+    """
+    Two 2D polynomials of the same degree sharing their monomial basis.
+
+    Parameters
+    ----------
+    degree : int
+        Degree of the polynomials.
+    coeffs : ndarray of shape (2, n_coeffs)
+        Coefficients of the x and y polynomials in the order of the
+        `~astropy.modeling.models.Polynomial2D` parameters.
+    """
+    def __init__(self, degree, coeffs):
+        coeffs = np.asarray(coeffs, dtype=np.float64)
+        ncoeffs = (degree + 1) * (degree + 2) // 2
+        if coeffs.shape != (2, ncoeffs):
+            raise ValueError("Expected coefficients of shape {0}, got {1}".format(
+                (2, ncoeffs), coeffs.shape))
+        self.degree = degree
+        self.coeffs = coeffs
+        # position of the coefficient of x**i * y**j in ``coeffs``
+        self._terms = poly2d_terms(degree)
+
+    @classmethod
+    def from_models(cls, xpoly, ypoly):
+        """
+        Create a pair from two `~astropy.modeling.models.Polynomial2D` models.
+        """
+        if xpoly.degree != ypoly.degree:
+            raise ValueError("The polynomials must have the same degree.")
+        return cls(xpoly.degree, [xpoly.parameters, ypoly.parameters])
+
+    @classmethod
+    def from_pcf(cls, pcffile, direction='Forward', block=0):
+        """
+        Create a pair from a ``.pcf`` file.
+
+        Parameters
+        ----------
+        pcffile : str or `~jwreftools.nirspec.utils.PcfDocument`
+            IDT file.
+        direction : str
+            "Forward" or "Backward".
+        block : int
+            0 for the polynomial, 1 for the distortion coefficients.
+        """
+        pcf = PcfDocument.read(pcffile)
+        xcoeffs, = pcf.polynomial_coefficients('x{0}Coefficients'.format(direction), (block,))
+        ycoeffs, = pcf.polynomial_coefficients('y{0}Coefficients'.format(direction), (block,))
+        return cls(pcf.fit_order, [xcoeffs, ycoeffs])
+
+    def to_models(self, name=""):
+        """ Return the pair as two `~astropy.modeling.models.Polynomial2D` models."""
+        xpoly = models.Polynomial2D(self.degree, name="{0}_x".format(name))
+        ypoly = models.Polynomial2D(self.degree, name="{0}_y".format(name))
+        xpoly.parameters = self.coeffs[0]
+        ypoly.parameters = self.coeffs[1]
+        return xpoly, ypoly
+
+    def __call__(self, x, y, chunk_size=65536):
+        """
+        Evaluate both polynomials.
+
+        The monomials are computed once for both polynomials, see
+        `evaluate_polynomials`. The inputs are processed in chunks of ``chunk_size``
+        elements so that the temporary arrays stay in the CPU cache.
+
+        Returns
+        -------
+        xout, yout : ndarray
+        """
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+                                   np.asarray(y, dtype=np.float64))
+        shape = x.shape
+        x = x.ravel()
+        y = y.ravel()
+        out = np.empty((2, x.size))
+        for start in range(0, x.size, chunk_size):
+            stop = start + chunk_size
+            evaluate_polynomials(self.degree, self._terms, self.coeffs, x[start:stop],
+                                 y[start:stop], out[:, start:stop])
+        return out[0].reshape(shape), out[1].reshape(shape)
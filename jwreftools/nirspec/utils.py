@@ -1,9 +1,71 @@
+import contextlib
+import functools
+import io
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
+from astropy.io import fits
 from astropy.modeling import models
 from astropy.modeling.models import Mapping, Identity
 from asdf import AsdfFile
 
-__all__ = ['pcf2model', 'linear_from_pcf_det2sky', 'coeffs_from_pcf']
+__all__ = ['pcf2model', 'linear_from_pcf_det2sky', 'coeffs_from_pcf', 'PcfDocument',
+           'coeffs_array_from_pcf', 'polynomial2d', 'affine_from_shifts', 'rotation_shift',
+           'parallel_map', 'fits_input']
+
+
+def affine_from_shifts(matrix, pre_shift=(0., 0.), post_shift=(0., 0.), name=None):
+    """
+    Fold ``Shift & Shift | AffineTransformation2D | Shift & Shift`` into one affine.
+
+    The returned transform computes ``matrix . (x + pre_shift) + post_shift``
+    with a single model.
+
+    Parameters
+    ----------
+    matrix : ndarray of shape (2, 2)
+        The matrix of the affine transform.
+    pre_shift, post_shift : iterable of two floats
+        Shifts applied to the inputs and the outputs of the matrix.
+    name : str
+        Name of the model.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    translation = np.dot(matrix, np.asarray(pre_shift, dtype=np.float64)) + \
+        np.asarray(post_shift, dtype=np.float64)
+    return models.AffineTransformation2D(matrix=matrix, translation=translation, name=name)
+
+
+def rotation_matrix(angle):
+    """ Return the matrix of `~astropy.modeling.models.Rotation2D` for ``angle`` in degrees."""
+    angle = np.deg2rad(angle)
+    return np.array([[np.cos(angle), -np.sin(angle)],
+                     [np.sin(angle), np.cos(angle)]])
+
+
+def rotation_shift(angle, xshift, yshift, name=None):
+    """
+    Fold ``Rotation2D(angle) | Shift(xshift) & Shift(yshift)`` into one affine.
+
+    Parameters
+    ----------
+    angle : float
+        Rotation angle in degrees.
+    xshift, yshift : float
+        Shifts applied after the rotation.
+    name : str
+        Name of the model.
+    """
+    return affine_from_shifts(rotation_matrix(angle), post_shift=(xshift, yshift), name=name)
+
+
+def _homothetic_matrices(angle, scale):
+    """ Return the det2sky and sky2det matrices of a homothetic transform."""
+    scale = np.array(scale, dtype=np.float64)
+    rotmat_det2sky = rotation_matrix(angle)
+    # The inverse of a rotation is its transpose, so both matrices are exact.
+    mat_det2sky = np.dot(rotmat_det2sky, np.diag(1 / scale))
+    mat_sky2det = np.dot(np.diag(scale), rotmat_det2sky.T)
+    return mat_det2sky, mat_sky2det
 
 
 def homothetic_det2sky(input_center, angle, scale, output_center, name=""):
@@ -11,6 +73,11 @@ def homothetic_det2sky(input_center, angle, scale, output_center, name=""):
     Create the homothetic transform from a .pcf file.
 
     The forward direction is sky to detector.
+
+    The chain ``Shift & Shift | AffineTransformation2D | Shift & Shift``
+    is folded into a single `~astropy.modeling.models.AffineTransformation2D`
+    whose inverse is set to the analytic sky to detector transform.
+
     Parameters
     ----------
     input_center : ndarray of shape (1, 2) or iterable
@@ -23,24 +90,14 @@ def homothetic_det2sky(input_center, angle, scale, output_center, name=""):
         (x, y) coordinate of the output rotation center
 
     """
-
-    input_center = np.array(input_center, dtype=np.float)
-    output_center = np.array(output_center, dtype=np.float)
-    scale = np.array(scale, dtype=np.float)
-    angle = np.deg2rad(angle)
-
-    rotmat_det2sky = [[np.cos(angle), -np.sin(angle)],
-                      [np.sin(angle), np.cos(angle)]]
-    scaling = np.array([[1/scale[0] , 0], [0, 1/scale[1]]])
-    mat_det2sky = np.dot(rotmat_det2sky, scaling)
-
-    aff = models.AffineTransformation2D(matrix=mat_det2sky,
-                                        name="{0}_affine_d2s".format(name))
-
-    transform = models.Shift(-output_center[0], name="{0}_xincen_d2s".format(name)) & \
-              models.Shift(-output_center[1],  name="{0}_yincen_d2s".format(name)) | \
-              aff | models.Shift(input_center[0],  name="{0}_xoutcen_d2s".format(name)) & \
-              models.Shift(input_center[1],  name="{0}_youtcen_d2s".format(name))
+    input_center = np.array(input_center, dtype=np.float64)
+    output_center = np.array(output_center, dtype=np.float64)
+    mat_det2sky, mat_sky2det = _homothetic_matrices(angle, scale)
+
+    transform = affine_from_shifts(mat_det2sky, -output_center, input_center,
+                                   name="{0}_affine_d2s".format(name))
+    transform.inverse = affine_from_shifts(mat_sky2det, -input_center, output_center,
+                                           name="{0}_affine".format(name))
     return transform
 
 
@@ -49,6 +106,11 @@ def homothetic_sky2det(input_center, angle, scale, output_center, name=""):
     Create the homothetic transform from a .pcf file.
 
     The forward direction is sky to detector.
+
+    The chain ``Shift & Shift | AffineTransformation2D | Shift & Shift``
+    is folded into a single `~astropy.modeling.models.AffineTransformation2D`
+    whose inverse is set to the analytic detector to sky transform.
+
     Parameters
     ----------
     input_center : ndarray of shape (1,2) or iterable
@@ -61,42 +123,227 @@ def homothetic_sky2det(input_center, angle, scale, output_center, name=""):
         (x, y) coordinate of the output rotation center
 
     """
+    input_center = np.array(input_center, dtype=np.float64)
+    output_center = np.array(output_center, dtype=np.float64)
+    mat_det2sky, mat_sky2det = _homothetic_matrices(angle, scale)
+
+    transform = affine_from_shifts(mat_sky2det, -input_center, output_center,
+                                   name="{0}_affine".format(name))
+    transform.inverse = affine_from_shifts(mat_det2sky, -output_center, input_center,
+                                           name="{0}_affine_d2s".format(name))
+    return transform
 
-    input_center = np.array(input_center, dtype=np.float)
-    output_center = np.array(output_center, dtype=np.float)
-    scale = np.array(scale, dtype=np.float)
-    angle = np.deg2rad(angle)
 
-    rotmat_sky2det = [[np.cos(angle), np.sin(angle)],
-                      [-np.sin(angle), np.cos(angle)]]
-    scaling = np.array([[scale[0] , 0], [0, scale[1]]])
-    mat_sky2det = np.dot(scaling, rotmat_sky2det)
+class PcfDocument(object):
+    """
+    An indexed view of a NIRSPEC IDT text reference file.
 
-    aff = models.AffineTransformation2D(matrix=mat_sky2det, name="{0}_affine".format(name))
+    The IDT files (``.pcf``, ``.fpa``) are made of sections, each starting
+    with a line ``*Keyword [arg ...]`` followed by the section values.
+    The file is read once and the offset of every section is recorded in a
+    single pass, so that sections are found with a dictionary lookup
+    instead of a ``lines.index`` scan.
 
+    Parameters
+    ----------
+    lines : list of str
+        Lines of the file, stripped of leading and trailing whitespace.
+    filename : str, optional
+        Name of the file the lines were read from.
 
-    transform = models.Shift(-input_center[0], name="{0}_xincen_s2d".format(name)) & \
-              models.Shift(-input_center[1], name="{0}_yincen_s2d".format(name)) | aff | \
-              models.Shift(output_center[0], name="{0}_xoutcen_s2d".format(name)) & \
-              models.Shift(output_center[1], name="{0}_youtcen_s2d".format(name))
-    return transform
+    Examples
+    --------
+    >>> pcf = PcfDocument.read("Camera.pcf")
+    >>> degree = pcf.fit_order
+    >>> xcoeffs = pcf.forward_coefficients('x')
+
+    """
+    def __init__(self, lines, filename=None):
+        self.lines = lines
+        self.filename = filename
+        # Hash of the file contents, set when the file is read through a cache.
+        self.digest = None
+        self._index = {}
+        self._blocks = {}
+        self.header = {'author': None, 'description': None, 'date': None}
+        for i, line in enumerate(lines):
+            if not line.startswith('*'):
+                continue
+            words = line[1:].split()
+            keyword = words[0] if words else ''
+            # Keep the first occurrence, as ``lines.index`` did.
+            self._index.setdefault(keyword, i)
+            # The header values are the line following *AUTHOR, *DESCRIPTION and *DATE.
+            if keyword.lower() in self.header and i + 1 < len(lines):
+                self.header[keyword.lower()] = lines[i + 1]
+
+    @classmethod
+    def read(cls, pcffile, cache=None):
+        """
+        Read an IDT text file.
+
+        Parameters
+        ----------
+        pcffile : str or `PcfDocument`
+            File name. A `PcfDocument` is returned unchanged.
+        cache : `~jwreftools.nirspec.cache.ModelCache`, optional
+            If given, the parsed file is taken from the cache when the
+            contents of the file have not changed.
+        """
+        if isinstance(pcffile, cls):
+            return pcffile
+        if cache is not None:
+            return cache.read(pcffile)
+        with open(pcffile, 'rb') as f:
+            return cls.from_bytes(f.read(), filename=pcffile)
+
+    @classmethod
+    def from_bytes(cls, data, filename=None):
+        """
+        Parse the contents of an IDT text file.
+
+        The lines are split as in a file opened in text mode, on ``\\n``,
+        ``\\r`` and ``\\r\\n``. Files read directly and through a cache are
+        parsed here, so they give the same document.
+        """
+        text = io.StringIO(data.decode('utf-8'), newline=None)
+        return cls([l.strip() for l in text.readlines()], filename=filename)
+
+    def __contains__(self, keyword):
+        return keyword in self._index
+
+    def offset(self, keyword):
+        """ Return the line number of section ``*keyword``."""
+        try:
+            return self._index[keyword]
+        except KeyError:
+            raise ValueError("Section '*{0}' not found in {1}".format(keyword, self.filename))
+
+    def section_args(self, keyword):
+        """ Return the arguments following the keyword on the section line."""
+        return self.lines[self.offset(keyword)].split()[1:]
+
+    def value(self, keyword):
+        """ Return the first line of section ``*keyword``."""
+        return self.lines[self.offset(keyword) + 1]
+
+    def values(self, keyword):
+        """ Return the whitespace separated values on the first line of a section."""
+        return self.value(keyword).split()
+
+    def tokens(self, keyword, count):
+        """
+        Return the first ``count`` values of a section.
+
+        Values may be written one per line or several per line.
+        """
+        tokens = []
+        for line in self.lines[self.offset(keyword) + 1:]:
+            if len(tokens) >= count or line.startswith('*'):
+                break
+            tokens.extend(line.split())
+        if len(tokens) < count:
+            raise ValueError("Expected {0} values in section '*{1}' of {2}, found {3}".format(
+                count, keyword, self.filename, len(tokens)))
+        return tokens[:count]
+
+    @property
+    def factors(self):
+        return [float(v) for v in self.values('Factor')]
+
+    @property
+    def rotation(self):
+        return float(self.value('Rotation'))
+
+    @property
+    def input_rotation_centre(self):
+        return [float(v) for v in self.values('InputRotationCentre')]
+
+    @property
+    def output_rotation_centre(self):
+        return [float(v) for v in self.values('OutputRotationCentre')]
+
+    @property
+    def fit_order(self):
+        return int(self.value('FitOrder'))
+
+    def coefficients(self, keyword, block=0):
+        """
+        Return a block of polynomial coefficients.
+
+        Coefficient sections are written as ``*xForwardCoefficients 21 2``,
+        i.e. the number of coefficients per block and the number of blocks.
+        Block 0 holds the polynomial coefficients and block 1, if present,
+        the coefficients of the distortion (chromatic) term.
+
+        Parameters
+        ----------
+        keyword : str
+            Section name, e.g. "xForwardCoefficients".
+        block : int
+            Index of the block.
+
+        Returns
+        -------
+        coeffs : ndarray
+            The coefficients in the order of the file.
+        """
+        try:
+            return self._blocks[keyword, block]
+        except KeyError:
+            pass
+        args = self.section_args(keyword)
+        if args:
+            ncoeffs = int(args[0])
+        else:
+            degree = self.fit_order
+            ncoeffs = (degree + 1) * (degree + 2) // 2
+        tokens = self.tokens(keyword, ncoeffs * (block + 1))
+        coeffs = np.array(tokens[ncoeffs * block:], dtype=np.float64)
+        self._blocks[keyword, block] = coeffs
+        return coeffs
+
+    def polynomial_coefficients(self, keyword, blocks=(0,)):
+        """
+        Return coefficient blocks in the order of the `Polynomial2D` parameters.
+
+        Parameters
+        ----------
+        keyword : str
+            Section name, e.g. "xForwardCoefficients".
+        blocks : tuple of int
+            Indices of the blocks, e.g. (0, 1) for the polynomial and the
+            distortion coefficients.
+
+        Returns
+        -------
+        coeffs : ndarray of shape (n_blocks, n_coeffs)
+        """
+        return coeffs_array_from_pcf(self.fit_order,
+                                     *[self.coefficients(keyword, b) for b in blocks])
+
+    def forward_coefficients(self, axis, block=0):
+        return self.coefficients('{0}ForwardCoefficients'.format(axis), block=block)
+
+    def backward_coefficients(self, axis, block=0):
+        return self.coefficients('{0}BackwardCoefficients'.format(axis), block=block)
+
+    def forward_distortion(self, axis):
+        return self.forward_coefficients(axis, block=1)
+
+    def backward_distortion(self, axis):
+        return self.backward_coefficients(axis, block=1)
 
 
 def linear_from_pcf_det2sky(pcffile, name=""):
-    with open(pcffile) as f:
-        lines = [l.strip() for l in f.readlines()]
-    factors = lines[lines.index('*Factor 2') + 1].split()
-    rotation_angle = float(lines[lines.index('*Rotation') + 1])
-    input_rot_center = lines[lines.index('*InputRotationCentre 2') + 1].split()
-    output_rot_center = lines[lines.index('*OutputRotationCentre 2') + 1].split()
-
-    det2sky = homothetic_det2sky(input_rot_center, rotation_angle,
-                                 factors, output_rot_center, name=name)
+    pcf = PcfDocument.read(pcffile)
+    det2sky = homothetic_det2sky(pcf.input_rotation_centre, pcf.rotation,
+                                 pcf.factors, pcf.output_rotation_centre, name=name)
     return det2sky
 
 
 
-def pcf2model(pcffile, name=""):
+def pcf2model(pcffile, name="", cache=None):
     """
     Create a model from a NIRSPEC Camera.pcf or Collimator*.pcf file.
 
@@ -121,11 +368,13 @@ def pcf2model(pcffile, name=""):
 
     Parameters
     ----------
-    pcffile : str
+    pcffile : str or `PcfDocument`
         one of the NIRSPEC ".pcf" reference files provided by the IDT team.
         "pcf" stands for "polynomial coefficients fit"
-    outname : str
-        Name of reference file to be wriiten to disk.
+    name : str
+        Prefix of the names of the models.
+    cache : `~jwreftools.nirspec.cache.ModelCache`, optional
+        Cache of parsed files and models.
 
     Returns
     -------
@@ -137,33 +386,26 @@ def pcf2model(pcffile, name=""):
     >>> pcf2asdf("Camera.pcf", "camera.asdf")
 
     """
-    linear_det2sky = linear_from_pcf_det2sky(pcffile, name=name)
+    pcf = PcfDocument.read(pcffile, cache=cache)
+    if cache is not None:
+        return cache.model(pcf, "pcf2model-{0}".format(name),
+                           lambda: pcf2model(pcf, name=name))
 
-    with open(pcffile) as f:
-        lines = [l.strip() for l in f.readlines()]
+    linear_det2sky = linear_from_pcf_det2sky(pcf, name=name)
 
-    degree = int(lines[lines.index('*FitOrder') + 1])
+    degree = pcf.fit_order
 
-    xcoeff_index = lines.index('*xForwardCoefficients 21 2')
-    xlines = lines[xcoeff_index + 1: xcoeff_index + 22]
-    xcoeff_forward = coeffs_from_pcf(degree, xlines)
-    x_poly_backward = models.Polynomial2D(degree, name='{0}_x_backward'.format(name),
-                                          **xcoeff_forward)
+    xcoeff_forward, = pcf.polynomial_coefficients('xForwardCoefficients')
+    x_poly_backward = polynomial2d(degree, xcoeff_forward, name='{0}_x_backward'.format(name))
 
-    ycoeff_index = lines.index('*yForwardCoefficients 21 2')
-    ycoeff_forward = coeffs_from_pcf(degree, lines[ycoeff_index + 1: ycoeff_index + 22])
-    y_poly_backward = models.Polynomial2D(degree, name='{0}_y_backward'.format(name),
-                                          **ycoeff_forward)
+    ycoeff_forward, = pcf.polynomial_coefficients('yForwardCoefficients')
+    y_poly_backward = polynomial2d(degree, ycoeff_forward, name='{0}_y_backward'.format(name))
 
-    xcoeff_index = lines.index('*xBackwardCoefficients 21 2')
-    xcoeff_backward = coeffs_from_pcf(degree, lines[xcoeff_index + 1: xcoeff_index + 22])
-    x_poly_forward = models.Polynomial2D(degree, name='{0}_x_forward'.format(name),
-                                         **xcoeff_backward)
+    xcoeff_backward, = pcf.polynomial_coefficients('xBackwardCoefficients')
+    x_poly_forward = polynomial2d(degree, xcoeff_backward, name='{0}_x_forward'.format(name))
 
-    ycoeff_index = lines.index('*yBackwardCoefficients 21 2')
-    ycoeff_backward = coeffs_from_pcf(degree, lines[ycoeff_index + 1: ycoeff_index + 22])
-    y_poly_forward = models.Polynomial2D(degree, name='{0}_y_forward'.format(name),
-                                         **ycoeff_backward)
+    ycoeff_backward, = pcf.polynomial_coefficients('yBackwardCoefficients')
+    y_poly_forward = polynomial2d(degree, ycoeff_backward, name='{0}_y_forward'.format(name))
 
     x_poly_forward.inverse = x_poly_backward
     y_poly_forward.inverse = y_poly_backward
@@ -179,6 +421,135 @@ def pcf2model(pcffile, name=""):
     return model
 
 
+@functools.lru_cache()
+def poly2d_index(degree):
+    """
+    Return the table mapping IDT coefficients to `Polynomial2D` parameters.
+
+    The IDT files list the coefficients ``c_i_j`` of a polynomial of
+    degree ``degree`` with ``i`` in the outer loop and ``j`` in the inner
+    loop, i.e. in a different order than `~astropy.modeling.models.Polynomial2D`.
+
+    Returns
+    -------
+    index : ndarray of int
+        ``coeffs[index]`` is the parameter vector of a `Polynomial2D`.
+    """
+    pcf_order = [(i, j) for i in range(degree + 1) for j in range(degree + 1 - i)]
+    position = dict((ij, k) for k, ij in enumerate(pcf_order))
+    param_names = models.Polynomial2D(degree).param_names
+    index = [position[tuple(int(p) for p in name[1:].split('_'))] for name in param_names]
+    return np.array(index, dtype=np.intp)
+
+
+def poly2d_terms(degree):
+    """
+    Return the table of the positions of the `Polynomial2D` parameters.
+
+    Returns
+    -------
+    terms : ndarray of int, shape (degree + 1, degree + 1)
+        ``terms[i, j]`` is the index of the coefficient of ``x**i * y**j`` in
+        the parameter vector of a `~astropy.modeling.models.Polynomial2D`.
+    """
+    terms = np.zeros((degree + 1, degree + 1), dtype=np.intp)
+    for k, name in enumerate(models.Polynomial2D(degree).param_names):
+        i, j = (int(p) for p in name[1:].split('_'))
+        terms[i, j] = k
+    return terms
+
+
+def coeffs_array_from_pcf(degree, *coeffslists):
+    """
+    Convert blocks of IDT coefficients to `Polynomial2D` parameter vectors.
+
+    Parameters
+    ----------
+    degree : int
+        Degree of the polynomials.
+    coeffslists : list or ndarray
+        One or more blocks of coefficients in the order of the IDT files.
+
+    Returns
+    -------
+    coeffs : ndarray of shape (n_blocks, n_coeffs)
+        Each row is the parameter vector of a `Polynomial2D`.
+    """
+    ncoeffs = (degree + 1) * (degree + 2) // 2
+    coeffs = np.array([c[:ncoeffs] for c in coeffslists], dtype=np.float64)
+    return coeffs[:, poly2d_index(degree)]
+
+
+def polynomial2d(degree, parameters, name=None):
+    """
+    Create a `Polynomial2D` from a parameter vector.
+
+    Parameters
+    ----------
+    degree : int
+        Degree of the polynomial.
+    parameters : ndarray
+        Coefficients in the order of `Polynomial2D.param_names`,
+        see `coeffs_array_from_pcf`.
+    name : str
+        Name of the model.
+    """
+    poly = models.Polynomial2D(degree, name=name)
+    poly.parameters = parameters
+    return poly
+
+
+@contextlib.contextmanager
+def fits_input(fitsfile):
+    """
+    Open an IDT FITS file memory mapped.
+
+    The table data of the HDUs are views of the file, so they can be passed
+    to the reference file models without being copied.
+
+    Parameters
+    ----------
+    fitsfile : str or `~astropy.io.fits.HDUList`
+        File name or an already open file, which is left open.
+    """
+    if isinstance(fitsfile, fits.HDUList):
+        yield fitsfile
+    else:
+        with fits.open(fitsfile, memmap=True) as f:
+            yield f
+
+
+def parallel_map(func, items, workers=None, processes=False):
+    """
+    Apply ``func`` to each item in a pool of threads or processes.
+
+    Used to read and parse sets of IDT files, where most of the time is
+    spent waiting for each file on network file systems.
+
+    Parameters
+    ----------
+    func : callable
+        Called with one item. Must be picklable if ``processes`` is True.
+    items : iterable
+        Arguments of ``func``.
+    workers : int, optional
+        Size of the pool. If None or 1 the items are processed serially.
+    processes : bool
+        If True use a process pool, otherwise a thread pool.
+
+    Returns
+    -------
+    results : list
+        ``func(item)`` for each item, in the order of ``items``.
+    """
+    items = list(items)
+    if workers is None or workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
 def coeffs_from_pcf(degree, coeffslist):
     coeffs = {}
     k = 0
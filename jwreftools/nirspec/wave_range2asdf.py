@@ -3,6 +3,7 @@ import numpy as np
 from jwst.datamodels import WavelengthrangeModel
 from astropy import units as u
 from asdf.tags.core import Software, HistoryEntry
+from .writer import write_reference
 
 
 __all__ = ["create_wavelengthrange_reference", "wavelength_range"]
@@ -60,7 +61,8 @@ def wavelength_range(spectral_conf, author, description, useafter):
     wr_model.meta.exposure.type = "N/A"
     return wr_model
 
-def create_wavelengthrange_reference(wave_range_file, output_name, author=None, description=None, useafter=None):
+def create_wavelengthrange_reference(wave_range_file, output_name, author=None, description=None, useafter=None,
+                                     write_options=None):
     f = open(wave_range_file)
     lines = [l.strip() for l in f.readlines()]
     f.close()
@@ -88,5 +90,5 @@ def create_wavelengthrange_reference(wave_range_file, output_name, author=None,
                          'homepage': 'https://github.com/spacetelescope/jwreftools', 'version': "0.7.1"})
     entry['software'] = software
     wr_model.history.append(entry)
-    wr_model.to_asdf(output_name)
+    write_reference(wr_model, output_name, reftype='wavelengthrange', **(write_options or {}))
     wr_model.validate()
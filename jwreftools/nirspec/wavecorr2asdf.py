@@ -23,12 +23,18 @@ Create the MSA ref file:
 
 """
 import datetime
+import warnings
 from astropy.io import fits
 from astropy.modeling import models
 from astropy import wcs
 import numpy as np
 from asdf.tags.core import HistoryEntry, Software
 from jwst.datamodels import WaveCorrModel
+from .utils import parallel_map
+from .writer import write_reference
+
+
+__all__ = ["create_wavecorr_refs", "uniform_axis", "UniformTable2D", "WaveCorrStack"]
 
 
 ap_names_map = {'A200_1': 'S200A1',
@@ -40,25 +46,258 @@ ap_names_map = {'A200_1': 'S200A1',
                 }
 
 
-def _wzpc2asdf(wzpcfile, author, description, useafter):
+def _is_separable(w):
+    """
+    Return True if each world axis of a 2D WCS depends only on its pixel axis.
+
+    This is the case for linear (non celestial) axes with a diagonal
+    PC/CD matrix and no distortion.
+    """
+    if w.has_celestial or w.sip is not None or w.cpdis1 is not None or \
+            w.cpdis2 is not None or w.det2im1 is not None or w.det2im2 is not None:
+        return False
+    pc = w.wcs.get_pc()
+    return pc[0, 1] == 0 and pc[1, 0] == 0
+
+
+def _wcs_axes(w, shape):
+    """
+    Return the world coordinates of the table axes.
+
+    The tables are tabulated on the world coordinates of the first row
+    (x axis) and the first column (y axis), so only these two lines of
+    pixels are evaluated instead of the full grid.
+    The WCS in the current ref files is 0-based.
+    """
+    ny, nx = shape
+    if not _is_separable(w):
+        warnings.warn("The WCS has cross terms; the zero-point table is tabulated "
+                      "on the first row and column of the grid.")
+    xaxis = w.all_pix2world(np.arange(nx), np.zeros(nx), 0)[0]
+    yaxis = w.all_pix2world(np.zeros(ny), np.arange(ny), 0)[1]
+    return xaxis, yaxis
+
+
+def uniform_axis(points, rtol=1e-9):
+    """
+    Return (start, step, n) if ``points`` are uniformly spaced, else None.
+
+    Parameters
+    ----------
+    points : ndarray
+        Coordinates of a table axis.
+    rtol : float
+        Tolerance on the spacing, relative to the step.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if points.size < 2:
+        return None
+    step = (points[-1] - points[0]) / (points.size - 1)
+    if step == 0 or not np.allclose(np.diff(points), step, rtol=0, atol=abs(step) * rtol):
+        return None
+    return [float(points[0]), float(step), int(points.size)]
+
+
+class UniformTable2D(object):
+    """
+    A table on a uniform 2D grid, evaluated with arithmetic bin indices.
+
+    This is the linear interpolation of `~astropy.modeling.models.Tabular2D`
+    with ``points`` given as (start, step, n) for each axis, so the cell of
+    each input is found without a search.
+
+    Parameters
+    ----------
+    xaxis, yaxis : list
+        (start, step, n) of the first and second axis of ``lookup_table``.
+    lookup_table : ndarray of shape (nx, ny)
+        Values on the grid, in the order of `~astropy.modeling.models.Tabular2D`,
+        i.e. the transpose of the (ny, nx) FITS image.
+    fill_value : float
+        Value outside the grid.
+    """
+    def __init__(self, xaxis, yaxis, lookup_table, fill_value=np.nan):
+        self.xaxis = [float(xaxis[0]), float(xaxis[1]), int(xaxis[2])]
+        self.yaxis = [float(yaxis[0]), float(yaxis[1]), int(yaxis[2])]
+        self.lookup_table = np.asarray(lookup_table, dtype=np.float64)
+        if self.lookup_table.shape != (self.xaxis[2], self.yaxis[2]):
+            raise ValueError("Expected a table of shape {0}, got {1}".format(
+                (self.xaxis[2], self.yaxis[2]), self.lookup_table.shape))
+        self.fill_value = fill_value
+
+    @classmethod
+    def from_tabular(cls, tabular, fill_value=np.nan):
+        """
+        Create the table from a `~astropy.modeling.models.Tabular2D` with uniform axes.
+        """
+        xaxis = uniform_axis(tabular.points[0])
+        yaxis = uniform_axis(tabular.points[1])
+        if xaxis is None or yaxis is None:
+            raise ValueError("The table axes are not uniformly spaced.")
+        return cls(xaxis, yaxis, tabular.lookup_table, fill_value=fill_value)
+
+    @classmethod
+    def from_aperture(cls, aperture, fill_value=np.nan):
+        """
+        Create the zero-point table of an aperture written by `create_wavecorr_refs`.
+
+        The (start, step, n) of the axes are not stored in the reference file,
+        which has no schema entry for them; they are found from the points
+        of the ``Tabular2D`` with `uniform_axis`.
+        """
+        return cls.from_tabular(aperture['zero_point_offset'], fill_value=fill_value)
+
+    @staticmethod
+    def _cell(axis, values):
+        """ Return the cell index and the fraction within the cell, or -1 outside the axis."""
+        start, step, n = axis
+        position = (values - start) / step
+        # tolerate rounding at the first and last points
+        outside = (position < -1e-9) | (position > n - 1 + 1e-9)
+        index = np.clip(np.floor(position).astype(np.intp), 0, n - 2)
+        fraction = position - index
+        index[outside] = -1
+        return index, fraction
+
+    def __call__(self, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+                                   np.asarray(y, dtype=np.float64))
+        shape = x.shape
+        x = x.ravel()
+        y = y.ravel()
+        i, fx = self._cell(self.xaxis, x)
+        j, fy = self._cell(self.yaxis, y)
+        outside = (i < 0) | (j < 0)
+        i[outside] = 0
+        j[outside] = 0
+        table = self.lookup_table
+        value = (table[i, j] * (1 - fx) * (1 - fy) + table[i + 1, j] * fx * (1 - fy) +
+                 table[i, j + 1] * (1 - fx) * fy + table[i + 1, j + 1] * fx * fy)
+        value[outside] = self.fill_value
+        return value.reshape(shape)
+
+
+class WaveCorrStack(object):
+    """
+    The zero-point tables of several apertures stacked in one array.
+
+    The zero-point offset and variance tables of all apertures are padded to
+    a common shape and stored as one array of shape
+    (n_apertures, nx, ny, 2), together with the (start, step, n) of the axes
+    of each aperture. Points from any mix of apertures are then evaluated in
+    one call with the linear interpolation of `UniformTable2D`.
+
+    Parameters
+    ----------
+    apertures : list of dict
+        The ``apertures`` of a wavecorr reference file, with uniform axes.
+        The ``variance`` is a (ny, nx) FITS image, it's transposed to the
+        (nx, ny) order of the zero-point tables.
+    fill_value : float
+        Value outside the table of an aperture.
+
+    Examples
+    --------
+    >>> stack = WaveCorrStack(model.apertures)
+    >>> ids = stack.aperture_ids(['S200A1', 'S400A1'])
+    >>> offset, variance = stack(ids, x, y)
+    """
+    def __init__(self, apertures, fill_value=np.nan):
+        tables = [UniformTable2D.from_aperture(ap) for ap in apertures]
+        self.names = [ap['aperture_name'] for ap in apertures]
+        self.fill_value = fill_value
+        self.start = np.array([[t.xaxis[0], t.yaxis[0]] for t in tables])
+        self.step = np.array([[t.xaxis[1], t.yaxis[1]] for t in tables])
+        self.npoints = np.array([[t.xaxis[2], t.yaxis[2]] for t in tables], dtype=np.intp)
+        nx, ny = self.npoints.max(axis=0)
+        self.tables = np.full((len(tables), nx, ny, 2), np.nan)
+        for k, (ap, table) in enumerate(zip(apertures, tables)):
+            variance = np.asarray(ap['variance'], dtype=np.float64).T
+            if variance.shape != table.lookup_table.shape:
+                raise ValueError("The variance of {0} has shape {1}, expected {2}".format(
+                    self.names[k], variance.shape, table.lookup_table.shape))
+            self.tables[k, :table.xaxis[2], :table.yaxis[2], 0] = table.lookup_table
+            self.tables[k, :table.xaxis[2], :table.yaxis[2], 1] = variance
+
+    def aperture_ids(self, names):
+        """ Return the ids of apertures given by name."""
+        ids = dict((name, k) for k, name in enumerate(self.names))
+        return np.array([ids[name] for name in np.atleast_1d(names)], dtype=np.intp)
+
+    def __call__(self, aperture_id, x, y):
+        """
+        Evaluate the zero-point offset and variance.
+
+        Parameters
+        ----------
+        aperture_id : int or ndarray of int
+            Index of the aperture of each point in ``names``.
+        x, y : float or ndarray
+            Coordinates on the table axes.
 
-    f = fits.open(wzpcfile)
-    width = f[1].header['width']
-    name = ap_names_map[f[0].header['COMPNAME']]
-    data = f[1].data
-    var = f[2].data
-    w = wcs.WCS(f[1].header)
-    f.close()
+        Returns
+        -------
+        offset, variance : ndarray
+        """
+        aperture_id, x, y = np.broadcast_arrays(np.asarray(aperture_id, dtype=np.intp),
+                                                np.asarray(x, dtype=np.float64),
+                                                np.asarray(y, dtype=np.float64))
+        shape = x.shape
+        ap = aperture_id.ravel()
+        if np.any((ap < 0) | (ap >= len(self.names))):
+            raise ValueError("Invalid aperture id.")
+        coords = np.column_stack([x.ravel(), y.ravel()])
+        position = (coords - self.start[ap]) / self.step[ap]
+        npoints = self.npoints[ap]
+        outside = np.any((position < -1e-9) | (position > npoints - 1 + 1e-9), axis=1)
+        index = np.clip(np.floor(position).astype(np.intp), 0, npoints - 2)
+        fraction = position - index
+        i, j = index.T
+        fx, fy = fraction.T
+        i[outside] = 0
+        j[outside] = 0
+        fx = fx[:, np.newaxis]
+        fy = fy[:, np.newaxis]
+        tables = self.tables
+        value = (tables[ap, i, j] * (1 - fx) * (1 - fy) + tables[ap, i + 1, j] * fx * (1 - fy) +
+                 tables[ap, i, j + 1] * (1 - fx) * fy + tables[ap, i + 1, j + 1] * fx * fy)
+        value[outside] = self.fill_value
+        return value[:, 0].reshape(shape), value[:, 1].reshape(shape)
+
+
+def _wzpc2asdf(wzpcfile):
+    """
+    Read one IDT wavelength zero-point file.
+
+    The file is opened once and only the two axes of the WCS are evaluated.
+    The (ny, nx) zero-point image is transposed to the (nx, ny) order of
+    the ``Tabular2D`` points; the variance is stored as read.
+
+    Returns
+    -------
+    aperture : dict
+        The aperture entry of the `WaveCorrModel`.
+    header : dict
+        AUTHOR, DESCRIP, PEDIGREE and DATE of the primary header. Missing
+        keywords are left out, so reading them raises a KeyError.
+    """
+    with fits.open(wzpcfile) as f:
+        header = dict((key, f[0].header[key]) for key in ['AUTHOR', 'DESCRIP', 'PEDIGREE', 'DATE']
+                      if key in f[0].header)
+        width = f[1].header['width']
+        name = ap_names_map[f[0].header['COMPNAME']]
+        data = f[1].data
+        var = f[2].data
+        w = wcs.WCS(f[1].header)
 
-    y, x = np.mgrid[: data.shape[0], : data.shape[1]]
-    # The WCS in the current ref files is 0-based.
-    X, Y = w.all_pix2world(x, y, 0)
-    tab = models.Tabular2D(points=(X[0], Y[:,0]), lookup_table=data)
+    xaxis, yaxis = _wcs_axes(w, data.shape)
+    tab = models.Tabular2D(points=(xaxis, yaxis), lookup_table=data.T)
     aperture = {'aperture_name': name, 'variance': var, 'zero_point_offset': tab, 'width': width}
-    return aperture
+    return aperture, header
 
 
-def create_wavecorr_refs(wzpc_files, outname=None, author=None, description=None, useafter="2015-11-01"):
+def create_wavecorr_refs(wzpc_files, outname=None, author=None, description=None, useafter="2015-11-01",
+                         write_options=None, workers=8):
     """
     Create WAVECORR reference files (Nirspec wavelength zero-point correction).
 
@@ -73,38 +312,39 @@ def create_wavecorr_refs(wzpc_files, outname=None, author=None, description=None
         Description of the file. If None will be read from the header.
     useafter : str
         Useafter date.
+    write_options : dict, optional
+        Arguments of `~jwreftools.nirspec.writer.write_reference`.
+    workers : int
+        Number of threads reading the files.
 
     """
     model = WaveCorrModel()
-    aps = []
     if isinstance(wzpc_files, list):
         # Create a reference file for the Fixed Slits mode.
         model.meta.exposure.type = "NRS_FIXEDSLIT"
         model.meta.exposure.p_exptype = "NRS_FIXEDSLIT|NRS_BRIGHTOBJ|"
-        for f in wzpc_files:
-            aps.append(_wzpc2asdf(f, author=author, description=description, useafter=useafter))
         if description is None:
             description = "Wavelength zero-point reference file for Nirspec fixed slits, computed using a simple toy model."
     elif isinstance(wzpc_files, str):
         model.meta.exposure.type = "NRS_MSASPEC"
         wzpc_files = [wzpc_files]
-        aps.append(_wzpc2asdf(wzpc_files[0], author=author, description=description, useafter=useafter))
     else:
         raise ValueError("Invalid input - expected a string or a list of strings.")
-    f0 = wzpc_files[0]
-    model.apertures = aps
+    results = parallel_map(_wzpc2asdf, wzpc_files, workers=workers)
+    model.apertures = [aperture for aperture, header in results]
+    # Header values are taken from the first file.
+    header = results[0][1]
     if author is None:
-        author = fits.getval(f0, 'AUTHOR')
+        author = header['AUTHOR']
     if description is None:
-        description = fits.getval(f0, 'DESCRIP')
-    pedigree = fits.getval(f0, 'PEDIGREE')
+        description = header['DESCRIP']
 
     model.meta.author = author
-    model.meta.pedigree = pedigree
+    model.meta.pedigree = header['PEDIGREE']
     model.meta.description = description
     model.meta.useafter = useafter
-    model.meta.date = fits.getval(f0, 'date')
-    model.meta.origin = fits.getval(f0, 'author')
+    model.meta.date = header['DATE']
+    model.meta.origin = header['AUTHOR']
     model.meta.instrument.p_detector = "NRS1|NRS2|"
 
     entry = HistoryEntry({'description': "NIRSPEC wavelength zero-point correction.", 'time': datetime.datetime.utcnow()})
@@ -114,4 +354,4 @@ def create_wavecorr_refs(wzpc_files, outname=None, author=None, description=None
     model.history.append(entry)
     if outname is None:
         outname = "nirspec_wavecorr.asdf"
-    model.to_asdf(outname)
+    write_reference(model, outname, reftype='wavecorr', **(write_options or {}))
@@ -0,0 +1,254 @@
+"""
+Writing of the NIRSPEC reference files.
+
+All ``create_*`` functions write their reference file with `write_reference`,
+so the ASDF array storage, the block compression and an optional float32
+downcast of large tables can be chosen per reference type.
+
+Examples
+--------
+Write the MSA file with compressed float32 tables:
+
+>>> create_msa_reference("MSA.msa", "nirspec_msa.asdf",
+...                      write_options={'compression': 'zlib', 'float32': True})
+
+Compare the size and load time of a reference file written in different ways:
+
+>>> benchmark("nirspec_msa.asdf")
+
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import asdf
+from astropy.modeling.tabular import Tabular
+
+
+__all__ = ['write_reference', 'write_options', 'benchmark']
+
+
+STORAGE = ['internal', 'inline', 'external']
+
+COMPRESSION = [None, 'zlib', 'bzp2', 'lz4']
+
+# Default write options of each reference type. Reference types which are
+# not listed use internal blocks without compression.
+WRITE_DEFAULTS = {
+    'disperser': {'storage': 'inline'},
+}
+
+# float64 arrays smaller than this are not downcast to float32.
+FLOAT32_MIN_SIZE = 1024
+
+# Reference types with large tables, for which a float32 downcast is useful.
+FLOAT32_REFTYPES = ['msa', 'wavecorr']
+
+
+def write_options(reftype=None, **overrides):
+    """
+    Return the write options of a reference type.
+
+    Parameters
+    ----------
+    reftype : str, optional
+        Reference type, e.g. "msa".
+    overrides : dict
+        ``storage``, ``compression`` or ``float32``. None values are ignored.
+
+    Returns
+    -------
+    options : dict
+        Values of ``storage``, ``compression`` and ``float32``.
+    """
+    options = {'storage': 'internal', 'compression': None, 'float32': False}
+    options.update(WRITE_DEFAULTS.get(reftype, {}))
+    options.update((key, value) for key, value in overrides.items() if value is not None)
+    unknown = set(options) - set(['storage', 'compression', 'float32'])
+    if unknown:
+        raise ValueError("Unknown write options: {0}".format(", ".join(sorted(unknown))))
+    if options['storage'] not in STORAGE:
+        raise ValueError("storage should be one of {0}".format(STORAGE))
+    if options['compression'] not in COMPRESSION:
+        raise ValueError("compression should be one of {0}".format(COMPRESSION))
+    return options
+
+
+def _is_float64(dtype):
+    """ True for 8 byte floats of either byte order, e.g. the ``>f8`` columns of FITS tables."""
+    return dtype.kind == 'f' and dtype.itemsize == 8
+
+
+def _is_array(node):
+    """ True for arrays, including the array proxies of a file read with asdf."""
+    return hasattr(node, 'dtype') and hasattr(node, '__array__')
+
+
+def _downcast(node, min_size=FLOAT32_MIN_SIZE):
+    """
+    Return ``node`` with its large float64 arrays and table columns as float32.
+
+    The lookup tables of tabular models, e.g. the wavecorr zero-point tables,
+    are downcast in place. The float32 arrays are in native byte order.
+    """
+    if isinstance(node, dict):
+        for key in node:
+            node[key] = _downcast(node[key], min_size)
+        return node
+    if isinstance(node, list):
+        return [_downcast(item, min_size) for item in node]
+    if isinstance(node, Tabular):
+        node.lookup_table = _downcast(node.lookup_table, min_size)
+        return node
+    if _is_array(node) and np.size(node) >= min_size:
+        array = np.asarray(node)
+        names = array.dtype.names
+        if names is not None:
+            types = [array.dtype[name] for name in names]
+            if any(_is_float64(dtype) for dtype in types):
+                return array.astype([(name, np.float32 if _is_float64(dtype) else dtype)
+                                     for name, dtype in zip(names, types)])
+        elif _is_float64(array.dtype):
+            return array.astype(np.float32)
+    return node
+
+
+def _float64_arrays(node, min_size=FLOAT32_MIN_SIZE):
+    """ Return the number of float64 arrays and table columns `_downcast` would convert."""
+    if isinstance(node, dict):
+        return sum(_float64_arrays(value, min_size) for value in node.values())
+    if isinstance(node, list):
+        return sum(_float64_arrays(item, min_size) for item in node)
+    if isinstance(node, Tabular):
+        return _float64_arrays(node.lookup_table, min_size)
+    if _is_array(node) and np.size(node) >= min_size:
+        dtype = np.asarray(node).dtype
+        if dtype.names is not None:
+            return sum(_is_float64(dtype[name]) for name in dtype.names)
+        return int(_is_float64(dtype))
+    return 0
+
+
+def write_reference(model, output_name, reftype=None, storage=None, compression=None,
+                    float32=None):
+    """
+    Write a reference file model to an ASDF file.
+
+    Parameters
+    ----------
+    model : `~jwst.datamodels.DataModel`
+        The reference file model.
+    output_name : str
+        Name of the ASDF file.
+    reftype : str, optional
+        Reference type, selects the defaults in ``WRITE_DEFAULTS``.
+    storage : str, optional
+        Array storage: "internal" (binary blocks), "inline" (YAML) or
+        "external" (one file per block next to ``output_name``).
+    compression : str, optional
+        Block compression: "zlib", "bzp2" or "lz4".
+    float32 : bool, optional
+        If True, large float64 arrays and table columns are written as float32.
+        A copy of the model is downcast; ``model`` is not modified.
+    """
+    options = write_options(reftype, storage=storage, compression=compression, float32=float32)
+    if options['float32']:
+        model = model.copy()
+        _downcast(model.instance)
+    kwargs = {'all_array_storage': options['storage']}
+    if options['compression'] is not None:
+        kwargs['all_array_compression'] = options['compression']
+    model.to_asdf(output_name, **kwargs)
+
+
+def _load(filename):
+    """ Read an ASDF file and all its arrays."""
+    with asdf.open(filename, lazy_load=False, memmap=False) as af:
+        nbytes = 0
+        for node in asdf.treeutil.iter_tree(af.tree):
+            if hasattr(node, 'nbytes'):
+                nbytes += np.asarray(node).nbytes
+    return nbytes
+
+
+def _size(directory):
+    """ Size of the files in a directory: an ASDF file and its external blocks."""
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def benchmark(filename, configurations=None, repeat=3):
+    """
+    Compare the size and load time of a reference file written in different ways.
+
+    The reference file is read once and written with each configuration in a
+    temporary directory. The load time is the best of ``repeat`` reads of the
+    file and all its arrays. Files written with ``float32`` are read back to
+    check that no large float64 array is left.
+
+    Parameters
+    ----------
+    filename : str
+        An ASDF reference file.
+    configurations : list of dict, optional
+        Arguments of `write_options`. Defaults to internal blocks with each
+        compression, inline arrays and compressed float32 arrays.
+    repeat : int
+        Number of reads of each file.
+
+    Returns
+    -------
+    results : list of dict
+        The configuration, size in bytes, write and load times in seconds.
+    """
+    if configurations is None:
+        configurations = [{'compression': compression} for compression in COMPRESSION]
+        configurations.append({'storage': 'inline'})
+        configurations.append({'compression': 'zlib', 'float32': True})
+    tmpdir = tempfile.mkdtemp()
+    results = []
+    try:
+        for i, config in enumerate(configurations):
+            options = write_options(**config)
+            directory = os.path.join(tmpdir, str(i))
+            os.mkdir(directory)
+            output = os.path.join(directory, "benchmark.asdf")
+            with asdf.open(filename, lazy_load=False, memmap=False) as af:
+                tree = af.tree
+                if options['float32']:
+                    tree = _downcast(tree)
+                kwargs = {'all_array_storage': options['storage']}
+                if options['compression'] is not None:
+                    kwargs['all_array_compression'] = options['compression']
+                start = time.time()
+                try:
+                    asdf.AsdfFile(tree).write_to(output, **kwargs)
+                except Exception as e:
+                    print("{0} could not be written: {1}".format(options, e))
+                    continue
+                write_time = time.time() - start
+            load_times = []
+            for j in range(repeat):
+                start = time.time()
+                _load(output)
+                load_times.append(time.time() - start)
+            if options['float32']:
+                with asdf.open(output, lazy_load=False, memmap=False) as af:
+                    remaining = _float64_arrays(af.tree)
+                if remaining:
+                    raise RuntimeError("{0} float64 arrays of {1} were not written as "
+                                       "float32.".format(remaining, filename))
+            results.append({'options': options, 'size': _size(directory),
+                            'write_time': write_time, 'load_time': min(load_times)})
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("{0:<10} {1:<12} {2:<8} {3:>12} {4:>10} {5:>10}".format(
+        "storage", "compression", "float32", "size", "write", "load"))
+    for result in results:
+        options = result['options']
+        print("{0:<10} {1:<12} {2:<8} {3:>12} {4:>9.3f}s {5:>9.3f}s".format(
+            options['storage'], str(options['compression']), str(options['float32']),
+            result['size'], result['write_time'], result['load_time']))
+    return results